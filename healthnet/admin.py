@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 from healthnet import models
-from healthnet.core.logging import LogEntry
+from healthnet.core.logging import LogEntry, LogRollup
 from healthnet.core.messages import Message
 from healthnet.core.users.administrator import Administrator
 from healthnet.core.users.doctor import Doctor
@@ -11,6 +11,7 @@ from healthnet.core.users.user import User
 
 admin.site.register(models.Hospital)
 admin.site.register(LogEntry)
+admin.site.register(LogRollup)
 admin.site.register(models.Appointment)
 admin.site.register(models.Calendar)
 admin.site.register(models.Prescription)
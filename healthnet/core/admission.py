@@ -0,0 +1,202 @@
+import math
+
+import django
+from django.db import models
+from django.db.models import F
+
+
+class Admission(models.Model):
+    """
+    One stay of a patient at a hospital, from admission to discharge
+    """
+    patient = models.ForeignKey('Patient', related_name='admissions')
+    hospital = models.ForeignKey('Hospital')
+    admitted = models.DateTimeField()
+    discharged = models.DateTimeField(blank=True, null=True)
+    length = models.IntegerField(blank=True, null=True)  # seconds, set at discharge
+
+    class Meta:
+        """
+        Meta class
+        """
+        # Discharge looks up the open stay
+        index_together = [('patient', 'discharged')]
+
+    @staticmethod
+    def admit(patient, when):
+        """
+        Start a stay at the patients current hospital
+        :param patient: The patient being admitted
+        :param when: The time of admission
+        :return: The admission
+        """
+        from healthnet.core.hospital import HospitalDailyStats
+
+        HospitalDailyStats.add(patient.hospital_id, django.utils.timezone.localtime(when).date(), admissions=1)
+        return Admission.objects.create(patient=patient, hospital_id=patient.hospital_id, admitted=when)
+
+    @staticmethod
+    def discharge(patient, when, hospital_id=None):
+        """
+        End the patients current stay, adding its length
+        to the running totals of the hospital it was at
+        :param patient: The patient being discharged
+        :param when: The time of discharge
+        :param hospital_id: The pk of the hospital the patient is leaving, if it is no longer
+                            their hospital, e.g. when they are being transferred
+        :return: The length of the stay in seconds, or None if it isn't known
+        """
+        from healthnet.core.hospital import Hospital, HospitalDailyStats
+
+        if hospital_id is None:
+            hospital_id = patient.hospital_id
+
+        stay = Admission.objects.filter(patient=patient, discharged__isnull=True).order_by('-admitted').first()
+        today = django.utils.timezone.localtime(when).date()
+
+        if stay is None and patient.last_admit_date is None:
+            HospitalDailyStats.add(hospital_id, today, discharges=1)
+            return None
+
+        if stay is None:
+            # Admitted before stays were recorded
+            stay = Admission(patient=patient, hospital_id=hospital_id, admitted=patient.last_admit_date)
+
+        stay.discharged = when
+        stay.length = int((when - stay.admitted).total_seconds())
+        stay.save()
+
+        Hospital.objects.filter(pk=stay.hospital_id).update(
+                visit_count=F('visit_count') + 1,
+                visit_length_sum=F('visit_length_sum') + stay.length,
+                visit_length_sumsq=F('visit_length_sumsq') + stay.length * stay.length)
+        HospitalDailyStats.add(stay.hospital_id, today, discharges=1, total_visit_length=stay.length)
+        VisitLengthBucket.add(stay.hospital_id, stay.length)
+
+        return stay.length
+
+    @staticmethod
+    def get_length_percentile(hospital, fraction):
+        """
+        Get a percentile of the visit lengths at a hospital, to within
+        half a percent; see VisitLengthBucket
+        :param hospital: The hospital
+        :param fraction: The percentile as a fraction, e.g. 0.5 for the median
+        :return: The length in seconds, or None if there have been no visits
+        """
+        return VisitLengthBucket.get_percentile(hospital, fraction)
+
+
+class VisitLengthBucket(models.Model):
+    """
+    How many visits to a hospital had a length in a range. Each range
+    is one percent wider than the one before it, so a percentile is read
+    from a couple of thousand rows at most however many visits there are.
+    """
+    hospital = models.ForeignKey('Hospital')
+    bucket = models.IntegerField()
+    count = models.IntegerField(default=0)
+
+    # How much wider each range is than the one before
+    GROWTH = 1.01
+
+    class Meta:
+        """
+        Meta class
+        """
+        unique_together = [('hospital', 'bucket')]
+
+    @staticmethod
+    def get_bucket(length):
+        """
+        Get the range a length falls in
+        :param length: The length in seconds
+        :return: The index of the range
+        """
+        return int(math.log1p(max(length, 0)) / math.log(VisitLengthBucket.GROWTH))
+
+    @staticmethod
+    def get_length(bucket):
+        """
+        Get the length in the middle of a range
+        :param bucket: The index of the range
+        :return: The length in seconds
+        """
+        return int(round(math.expm1((bucket + 0.5) * math.log(VisitLengthBucket.GROWTH))))
+
+    @staticmethod
+    def add(hospital_id, length, count=1):
+        """
+        Count visits to a hospital
+        :param hospital_id: The pk of the hospital
+        :param length: The length of the visits in seconds
+        :param count: The number of visits
+        :return: None
+        """
+        from healthnet.core.hospital import add_counts
+        add_counts(VisitLengthBucket, {'hospital_id': hospital_id, 'bucket': VisitLengthBucket.get_bucket(length)},
+                   {'count': count})
+
+    @staticmethod
+    def get_percentile(hospital, fraction):
+        """
+        Get a percentile of the visit lengths at a hospital
+        :param hospital: The hospital
+        :param fraction: The percentile as a fraction, e.g. 0.5 for the median
+        :return: The length in seconds, or None if there have been no visits
+        """
+        buckets = list(VisitLengthBucket.objects.filter(hospital=hospital, count__gt=0).order_by('bucket')
+                       .values_list('bucket', 'count'))
+        total = sum(count for _, count in buckets)
+        if total == 0:
+            return None
+
+        index = int(round(fraction * (total - 1)))
+        for bucket, count in buckets:
+            if index < count:
+                return VisitLengthBucket.get_length(bucket)
+            index -= count
+
+
+class RunningStats(object):
+    """
+    Mean and variance from a running count, sum and sum of squares,
+    so neither needs the values that were added
+    """
+
+    @staticmethod
+    def mean(count, total):
+        """
+        Get the mean
+        :param count: The number of values
+        :param total: The sum of the values
+        :return: The mean, or 0 if there are no values
+        """
+        if count == 0:
+            return 0
+        return total / count
+
+    @staticmethod
+    def variance(count, total, total_sq):
+        """
+        Get the population variance
+        :param count: The number of values
+        :param total: The sum of the values
+        :param total_sq: The sum of the squares of the values
+        :return: The variance, or 0 if there are no values
+        """
+        if count == 0:
+            return 0
+        # Integer arithmetic until the final division keeps this exact
+        return (count * total_sq - total * total) / (count * count)
+
+    @staticmethod
+    def stddev(count, total, total_sq):
+        """
+        Get the population standard deviation
+        :param count: The number of values
+        :param total: The sum of the values
+        :param total_sq: The sum of the squares of the values
+        :return: The standard deviation, or 0 if there are no values
+        """
+        return math.sqrt(RunningStats.variance(count, total, total_sq))
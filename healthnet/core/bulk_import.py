@@ -0,0 +1,347 @@
+import collections
+import re
+from datetime import date as date_type
+from datetime import datetime as datetime_type
+
+import django
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from healthnet.core.calendar import Appointment
+from healthnet.core.hospital import Hospital, HospitalDailyPrescriptions
+from healthnet.core.insurance import InsuranceNumberGenerator
+from healthnet.core.logging import LogEntry, LogLevel, Logging
+from healthnet.core.prescription import Prescription
+from healthnet.core.result import Result
+from healthnet.core.users.administrator import Administrator
+from healthnet.core.users.doctor import Doctor
+from healthnet.core.users.nurse import Nurse
+from healthnet.core.users.patient import Patient
+from healthnet.core.users.user import User
+
+
+class BulkImportBackend(object):
+    """
+    The create_* functions for HealthNetImport, writing rows in
+    batches instead of one at a time. Primary keys are handed out
+    up front so each create_* can return one before its row is written,
+    and each batch is written with one INSERT per table in a transaction.
+    If a batch fails, its objects are written one at a time so only the
+    bad ones are lost, and rows referencing those are refused.
+    """
+
+    # How the export writes a prescription's expiration date into its notes
+    EXPIRES_RE = re.compile(r'^Expires: (\d{4}-\d{2}-\d{2})\n')
+
+    def __init__(self, batch_size=1000, using=DEFAULT_DB_ALIAS):
+        """
+        Initialize the backend
+        :param batch_size: The number of objects written per transaction
+        :param using: The database to write to
+        """
+        self.batch_size = batch_size
+        self.using = using
+
+        # Checked in memory instead of with a query per user
+        self.usernames = set(User.objects.using(using).values_list('username', flat=True))
+        self.user_pks = set(User.objects.using(using).values_list('pk', flat=True))
+        self.insurance_numbers = InsuranceNumberGenerator(using=using)
+
+        self.next_pk = {}
+        self.pending = []
+        self.pending_section = None
+        self.written = collections.Counter()
+
+        # Per section; what HealthNetImport counts is only what was queued
+        self.created = collections.Counter()
+        self.failed = collections.Counter()
+
+        # The pks of users and hospitals that were handed out but failed to write
+        self.failed_pks = {User: set(), Hospital: set()}
+
+        # (patient pk, issue date, name) -> written prescriptions, for the daily statistics
+        self.prescriptions = collections.Counter()
+
+    def allocate_pk(self, model):
+        """
+        Hand out the next primary key of a model
+        :param model: The model
+        :return: The primary key
+        """
+        if model not in self.next_pk:
+            last = model.objects.using(self.using).order_by('-pk').values_list('pk', flat=True).first()
+            self.next_pk[model] = (last or 0) + 1
+
+        pk = self.next_pk[model]
+        self.next_pk[model] += 1
+        return pk
+
+    def check_refs(self, model, *pks, required=False):
+        """
+        Refuse an object that references users or hospitals which failed to write
+        :param model: User or Hospital
+        :param pks: The referenced pks
+        :param required: Whether the references can't be None
+        :return: None
+        """
+        for pk in pks:
+            if pk is None:
+                if required:
+                    raise ValueError('A %s is required' % model._meta.verbose_name)
+            elif pk in self.failed_pks[model]:
+                raise ValueError('The %s %d failed to import' % (model._meta.verbose_name, pk))
+
+    def queue(self, section, objs, failed_pk=None):
+        """
+        Queue one object to be written, writing the batch when it is full
+        or when a new section starts so rows are written after the
+        rows they reference
+        :param section: The name of the section the object belongs to
+        :param objs: The unsaved object followed by any rows that belong to it, e.g. its many to many rows
+        :param failed_pk: The (model, pk) to record in failed_pks if the object fails to write
+        :return: None
+        """
+        if section != self.pending_section:
+            self.flush()
+            self.pending_section = section
+
+        self.pending.append((objs, failed_pk))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write every queued object in one transaction, or one
+        at a time if the transaction fails
+        :return: None
+        """
+        pending, section = self.pending, self.pending_section
+        self.pending = []
+
+        if not pending:
+            return
+
+        try:
+            self.write([obj for objs, _ in pending for obj in objs])
+            self.created[section] += len(pending)
+            return
+        except Exception:
+            pass
+
+        for objs, failed_pk in pending:
+            try:
+                self.write(objs)
+                self.created[section] += 1
+            except Exception as e:
+                # Raising would be swallowed by HealthNetImport, so count it for the report
+                Logging.warning('Failed to import one of the %s: %s' % (section, e))
+                self.failed[section] += 1
+                if failed_pk is not None:
+                    model, pk = failed_pk
+                    self.failed_pks[model].add(pk)
+
+    def write(self, objs):
+        """
+        Write objects in one transaction, with one INSERT per table
+        :param objs: The unsaved objects, in the order their tables must be written
+        :return: None
+        """
+        by_model = collections.OrderedDict()
+        for obj in objs:
+            by_model.setdefault(type(obj), []).append(obj)
+
+        with transaction.atomic(using=self.using):
+            for model, model_objs in by_model.items():
+                if issubclass(model, User):
+                    self.insert_users(model, model_objs)
+                else:
+                    model.objects.using(self.using).bulk_create(model_objs)
+
+        for model, model_objs in by_model.items():
+            self.written[model] += len(model_objs)
+
+        for obj in by_model.get(Prescription, []):
+            if obj.patient_id is not None:
+                self.prescriptions[(obj.patient_id, obj.issue_date, obj.name)] += 1
+
+    def insert_users(self, model, objs):
+        """
+        Insert users of a type, which bulk_create can't do because
+        the type's table and the user table both need a row
+        :param model: The type of user
+        :param objs: The unsaved users, with their pks set
+        :return: None
+        """
+        user_fields = User._meta.concrete_fields
+        User.objects.using(self.using).bulk_create(
+                [User(**{f.attname: getattr(obj, f.attname) for f in user_fields}) for obj in objs])
+
+        fields = model._meta.local_concrete_fields
+        connection = connections[self.using]
+        size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+        for i in range(0, len(objs), size):
+            model._base_manager._insert(objs[i:i + size], fields=fields, using=self.using)
+
+    def finish(self):
+        """
+        Write whatever is left, move the databases id sequences past the
+        primary keys that were handed out and count the prescriptions
+        in the daily statistics
+        :return: A summary of what was imported
+        """
+        self.flush()
+
+        connection = connections[self.using]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), list(self.next_pk)):
+                cursor.execute(sql)
+
+        self.add_prescription_stats()
+
+        summary = ', '.join('%d %s' % (count, model._meta.verbose_name_plural)
+                            for model, count in self.written.items())
+        failed = sum(self.failed.values())
+        if failed:
+            summary += ', %d failed' % failed
+        Logging.info('Imported %s' % (summary or 'nothing'), print_stdout=False)
+        return summary
+
+    def add_prescription_stats(self):
+        """
+        Count the written prescriptions in their hospitals' daily
+        statistics, which bulk_create skips by not calling save
+        :return: None
+        """
+        patient_ids = list({patient_id for patient_id, _, _ in self.prescriptions})
+        hospitals = {}
+        # Chunked to stay under SQLite's limit on query parameters
+        for i in range(0, len(patient_ids), 500):
+            hospitals.update(Patient.objects.using(self.using).filter(pk__in=patient_ids[i:i + 500])
+                             .values_list('pk', 'hospital_id'))
+
+        counts = collections.Counter()
+        for (patient_id, issue_date, name), count in self.prescriptions.items():
+            counts[(hospitals[patient_id], issue_date, name)] += count
+
+        with transaction.atomic(using=self.using):
+            for (hospital_id, issue_date, name), count in counts.items():
+                HospitalDailyPrescriptions.add(hospital_id, issue_date, name, count)
+
+        self.prescriptions.clear()
+
+    def new_user(self, model, username, password_hash, email, first_name, last_name, **fields):
+        """
+        Build a user of a type with a new primary key
+        :param model: The type of user
+        :param username: The username, which must not be taken
+        :param password_hash: The already hashed password
+        :param fields: Other fields of the user
+        :return: The unsaved user
+        """
+        if username in self.usernames:
+            raise ValueError("A user with the username '%s' already exists" % username)
+
+        pk = self.allocate_pk(User)
+        self.usernames.add(username)
+        self.user_pks.add(pk)
+
+        # bulk_create doesn't call save, so the search fields are set here
+        return model(id=pk, user_ptr_id=pk, username=username, password=password_hash, email=email,
+                     first_name=first_name, last_name=last_name, search_username=username.lower(),
+                     search_first_name=(first_name or '').lower(), search_last_name=(last_name or '').lower(),
+                     is_pending=False, **fields)
+
+    def add_hospital(self, name: str, addr: str):
+        hospital = Hospital(pk=self.allocate_pk(Hospital), name=name, address_line_1=addr, city="", state=0,
+                            zipcode="")
+        self.queue('hospitals', [hospital], (Hospital, hospital.pk))
+        return hospital.pk
+
+    def add_admin(self, username: str, password_hash: str, first_name: str, last_name: str, middle_name: str,
+                  dob: date_type, addr: str, email: str, phone: str, primary_hospital_id: int, hospital_ids: list):
+        self.check_refs(Hospital, primary_hospital_id)
+        user = self.new_user(Administrator, username, password_hash, email, first_name, last_name, is_admin=True,
+                             hospital_id=primary_hospital_id)
+        self.queue('admins', [user], (User, user.pk))
+        return user.pk
+
+    def add_doctor(self, username: str, password_hash: str, first_name: str, last_name: str, middle_name: str,
+                   dob: date_type, addr: str, email: str, phone: str, hospital_ids: list, patient_ids: list):
+        hospital_ids = set(hospital_ids or []) - self.failed_pks[Hospital]
+        user = self.new_user(Doctor, username, password_hash, email, first_name, last_name, is_doctor=True)
+        self.queue('doctors', [user] + [Doctor.hospitals.through(doctor_id=user.pk, hospital_id=h)
+                                        for h in hospital_ids], (User, user.pk))
+        return user.pk
+
+    def add_nurse(self, username: str, password_hash: str, first_name: str, last_name: str, middle_name: str,
+                  dob: date_type, addr: str, email: str, phone: str, primary_hospital_id: list, doctor_ids: list):
+        self.check_refs(Hospital, primary_hospital_id)
+        user = self.new_user(Nurse, username, password_hash, email, first_name, last_name, is_nurse=True,
+                             hospital_id=primary_hospital_id)
+        self.queue('nurses', [user], (User, user.pk))
+        return user.pk
+
+    def add_patient(self, username: str, password_hash: str, first_name: str, middle_name: str, last_name: str,
+                    dob: date_type, addr: str, email: str, phone: str, emergency_contact: str, eye_color: str,
+                    bloodtype: str, height: int, weight: int, primary_hospital_id: int, primary_doctor_id: int,
+                    doctor_ids: list):
+        self.check_refs(Hospital, primary_hospital_id, required=True)
+        self.check_refs(User, primary_doctor_id, required=True)
+        user = self.new_user(Patient, username, password_hash, email, first_name, last_name, is_patient=True,
+                             primary_care_provider_id=primary_doctor_id, hospital_id=primary_hospital_id,
+                             health_insurance_number=self.insurance_numbers.next(), height=height,
+                             weight=weight, cholesterol=0, dob=dob, home_phone=phone,
+                             emergency_contact=emergency_contact or '')
+        self.queue('patients', [user], (User, user.pk))
+        return user.pk
+
+    def add_appointment(self, start: datetime_type, end: datetime_type, location: str, description: str,
+                        doctor_ids: list, nurse_ids: list, patient_ids: list):
+        attendee_ids = [pk for pk in (doctor_ids or []) + (nurse_ids or []) + (patient_ids or [])
+                        if pk in self.user_pks and pk not in self.failed_pks[User]]
+        apt = Appointment(pk=self.allocate_pk(Appointment), name=description, description=description,
+                          creator_id=min(attendee_ids) if attendee_ids else None,
+                          tstart=django.utils.timezone.make_aware(start), tend=django.utils.timezone.make_aware(end))
+        self.queue('appointments', [apt] + [Appointment.attendees.through(appointment_id=apt.pk, user_id=pk)
+                                            for pk in set(attendee_ids)])
+        return apt.pk
+
+    def add_prescription(self, name: str, dosage: int, notes: str, doctor_id: int, patient_id: int):
+        self.check_refs(User, doctor_id, patient_id)
+        issue_date = timezone.localtime(timezone.now()).date()
+        expiration_date = issue_date
+        match = self.EXPIRES_RE.match(notes or '')
+        if match is not None:
+            expiration_date = datetime_type.strptime(match.group(1), '%Y-%m-%d').date()
+            notes = notes[match.end():]
+        self.queue('prescriptions',
+                   [Prescription(name=name, refills=dosage, description=notes, doctor_id=doctor_id,
+                                 patient_id=patient_id, state=0, issue_date=issue_date,
+                                 expiration_date=expiration_date)])
+
+    def add_test(self, name: str, date: date_type, description: str, results: str, released: bool, doctor_id: int,
+                 patient_id: int):
+        self.check_refs(User, doctor_id, patient_id)
+        self.queue('tests',
+                   [Result(test_type=name, test_date=date, description=description, comment=results,
+                           is_released=released, doctor_id=doctor_id, patient_id=patient_id)])
+
+    def add_log_entry(self, user_id: int, request_method: str, request_secure: bool, request_addr: str,
+                      description: str, hospital_id: int):
+        # LogEntry has no user, hospital or request columns, so whatever is known is kept in the message.
+        # The user id doesn't say which section it indexes, so it can't be mapped to a pk.
+        details = []
+        if user_id is not None:
+            details.append('exported user %d' % user_id)
+        if hospital_id is not None:
+            details.append('hospital %d' % hospital_id)
+        if request_method:
+            details.append('%s %s' % ('HTTPS' if request_secure else 'HTTP', request_method))
+        if request_addr:
+            details.append('from %s' % request_addr)
+        if details:
+            description = '%s (%s)' % (description, ', '.join(details))
+
+        self.queue('log_entries', [LogEntry(datetime=timezone.now(), level=LogLevel.Info, message=description)])
@@ -1,38 +1,56 @@
 import datetime
 import json
+from datetime import timedelta
 
 import django
 from django.core.urlresolvers import reverse
 from django.db import models
+from django.utils.dateparse import parse_date, parse_datetime
 
 from healthnet.core.logging import Logging
 from healthnet.core.users.user import User
 
 
 class Calendar(models.Model):
+    # The longest window free slots are listed for, enough for a month view
+    MAX_FREE_SLOTS_WINDOW = timedelta(days=42)
+
     @staticmethod
     def get_appointments_for_attendee_for_day(attendee: User, date: datetime):
         """
         Gets a list of Appointments for the selected user and date
         :param attendee: User selected
-        :param date: Date selected
+        :param date: Date selected; naive dates are taken to be in the current timezone
         :return: apts: list of appointments
         """
-        apts = []
-        for apt in attendee.get_appointments():
-            if date.date() == apt.tstart.date() and not apt.is_in_past():
-                apts += [apt]
-        return apts
+        if django.utils.timezone.is_aware(date):
+            date = django.utils.timezone.localtime(date)
+
+        # Bounds of the day in the current timezone
+        day_start = django.utils.timezone.make_aware(datetime.datetime.combine(date.date(), datetime.time.min))
+        day_end = django.utils.timezone.make_aware(
+            datetime.datetime.combine(date.date() + timedelta(days=1), datetime.time.min))
+
+        return list(attendee.get_appointments().filter(tstart__gte=day_start, tstart__lt=day_end,
+                                                       tend__gte=django.utils.timezone.now()).order_by('tstart'))
 
     @staticmethod
-    def get_appointments_json(attendee: User):
+    def get_appointments_json(attendee: User, start=None, end=None):
         """
         Get the appointments that the current user is in
         :param attendee: User currently logged in
+        :param start: Only include appointments ending after this time; None for no lower bound
+        :param end: Only include appointments starting before this time; None for no upper bound
         :return:
         """
         apts = []
-        for apt in attendee.get_appointments().all():
+        qs = attendee.get_appointments()
+        if start is not None:
+            qs = qs.filter(tend__gt=start)
+        if end is not None:
+            qs = qs.filter(tstart__lt=end)
+
+        for apt in qs.order_by('tstart'):
             apts += [
                 {
                     'id': apt.pk,
@@ -67,6 +85,138 @@ class Calendar(models.Model):
                 ]
         return json.dumps(apts)
 
+    @staticmethod
+    def merge_intervals(intervals):
+        """
+        Merges overlapping or touching intervals
+        :param intervals: An iterable of (start, end) tuples
+        :return: A sorted list of non-overlapping (start, end) tuples
+        """
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged += [(start, end)]
+        return merged
+
+    @staticmethod
+    def get_free_slots(busy, window, duration, granularity, limit=None):
+        """
+        Sweeps over busy intervals and collects the open slots between them
+        :param busy: An iterable of (start, end) tuples that are already taken
+        :param window: A (start, end) tuple to search for slots in
+        :param duration: The length of a slot as a timedelta
+        :param granularity: The spacing between possible slot starts as a timedelta
+        :param limit: The maximum number of slots to return; None for no limit
+        :return: A list of (start, end) tuples of open slots
+        """
+        window_start, window_end = window
+        slots = []
+        cursor = window_start
+
+        for busy_start, busy_end in Calendar.merge_intervals(busy) + [(window_end, window_end)]:
+            # Round the cursor up to the next slot boundary
+            candidate = window_start - ((window_start - cursor) // granularity) * granularity
+            gap_end = min(busy_start, window_end)
+
+            while candidate + duration <= gap_end:
+                if limit is not None and len(slots) >= limit:
+                    return slots
+                slots += [(candidate, candidate + duration)]
+                candidate += granularity
+
+            cursor = max(cursor, busy_end)
+            if cursor >= window_end:
+                break
+
+        return slots
+
+    @staticmethod
+    def get_free_slots_window(start, end, granularity=timedelta(minutes=30)):
+        """
+        Get the window to list free slots in, from the times the calendar
+        widget asked for. Only the future is searched, starting at the next
+        slot boundary, and the window is at most MAX_FREE_SLOTS_WINDOW long.
+        :param start: The start of the visible range; None for now
+        :param end: The end of the visible range; None for a week after the start
+        :param granularity: The spacing between possible slot starts as a timedelta
+        :return: A (start, end) tuple
+        """
+        now = django.utils.timezone.now()
+        if start is None or start < now:
+            # Slot boundaries are counted from local midnight
+            local = django.utils.timezone.localtime(now)
+            midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+            start = midnight - ((midnight - local) // granularity) * granularity
+
+        if end is None:
+            end = start + timedelta(days=7)
+
+        return start, max(min(end, start + Calendar.MAX_FREE_SLOTS_WINDOW), start)
+
+    @staticmethod
+    def find_free_slots(attendees, window, duration=timedelta(minutes=30), granularity=timedelta(minutes=30),
+                        limit=10):
+        """
+        Finds the first open slots that all attendees are available for
+        :param attendees: Users that must all be free
+        :param window: A (start, end) tuple to search for slots in
+        :param duration: The length of a slot as a timedelta
+        :param granularity: The spacing between possible slot starts as a timedelta
+        :param limit: The maximum number of slots to return; None for no limit
+        :return: A list of (start, end) tuples of open slots
+        """
+        window_start, window_end = window
+        busy = Appointment.objects.filter(attendees__in=attendees, tstart__lt=window_end, tend__gt=window_start) \
+            .values_list('tstart', 'tend').distinct()
+        return Calendar.get_free_slots(busy, window, duration, granularity, limit)
+
+    @staticmethod
+    def get_free_slots_json(attendees, window, duration=timedelta(minutes=30), granularity=timedelta(minutes=30),
+                            limit=10):
+        """
+        Get the open slots for attendees as calendar events
+        :param attendees: Users that must all be free
+        :param window: A (start, end) tuple to search for slots in
+        :param duration: The length of a slot as a timedelta
+        :param granularity: The spacing between possible slot starts as a timedelta
+        :param limit: The maximum number of slots to return; None for no limit
+        :return: A JSON string of open slots
+        """
+        slots = []
+        for start, end in Calendar.find_free_slots(attendees, window, duration, granularity, limit):
+            slots += [
+                {
+                    'title': 'Available',
+                    'start': django.utils.timezone.localtime(start).strftime('%Y-%m-%dT%H:%M:%S'),
+                    'end': django.utils.timezone.localtime(end).strftime('%Y-%m-%dT%H:%M:%S'),
+                }
+            ]
+        return json.dumps(slots)
+
+    @staticmethod
+    def parse_time(value):
+        """
+        Parses a date or datetime string sent by the calendar widget
+        :param value: An ISO 8601 date or datetime string
+        :return: An aware datetime or None if the string could not be parsed
+        """
+        if value is None:
+            return None
+
+        time = parse_datetime(value)
+        if time is None:
+            day = parse_date(value)
+            if day is None:
+                return None
+            time = datetime.datetime.combine(day, datetime.time.min)
+
+        if django.utils.timezone.is_naive(time):
+            time = django.utils.timezone.make_aware(time)
+        return time
+
     @staticmethod
     def create_appointment(attendees, creator, name, desc, start, end):
         """
@@ -152,18 +302,13 @@ class Calendar(models.Model):
         :param ignore_apt: any appointments that can be ignored
         :return: True if there is a conflict, False if there is not
         """
-        attendees = set(attendees)
+        # Two appointments overlap when each one starts before the other ends
+        apts = Appointment.objects.filter(attendees__in=attendees, tstart__lt=end, tend__gt=start)
 
-        for apt in Appointment.objects.all():
-            if ignore_apt is not None and apt.pk == ignore_apt.pk:
-                continue
+        if ignore_apt is not None and ignore_apt.pk is not None:
+            apts = apts.exclude(pk=ignore_apt.pk)
 
-            if set(apt.attendees.all()).intersection(attendees):
-                if (apt.tstart > start) and (apt.tstart < end) or \
-                                (apt.tend > start) and (apt.tstart < end) or \
-                                (apt.tstart < start) and (apt.tend > end):
-                    return True
-        return False
+        return apts.exists()
 
 
 class Appointment(models.Model):
@@ -177,6 +322,12 @@ class Appointment(models.Model):
     attendees = models.ManyToManyField(User)
     creator = models.ForeignKey(User, related_name="created_appointments", null=True)
 
+    class Meta:
+        """
+        Meta class
+        """
+        index_together = [('tstart', 'tend')]
+
     def has_conflict(self):
         """
         Check if the appointment has a conflict with any
@@ -5,7 +5,7 @@ from django.forms import SelectDateWidget
 from django.http import request
 
 from healthnet.core.enumfield import EnumField
-from healthnet.core.messages import MessageType
+from healthnet.core.messages import MessageType, BroadcastTarget
 from healthnet.core.users.administrator import Administrator
 from healthnet.core.users.doctor import Doctor
 from healthnet.core.users.nurse import Nurse
@@ -220,7 +220,8 @@ class SendMessageForm(forms.Form):
     """
     Form to send a message
     """
-    recipient = forms.ModelChoiceField(queryset=None)
+    # Filled in by the autocomplete on the page rather than a list of every user
+    recipient = forms.ModelChoiceField(queryset=None, widget=forms.HiddenInput)
     type = forms.ChoiceField(choices=MessageType.get_choices())
     message = forms.CharField(widget=forms.Textarea)
 
@@ -241,6 +242,46 @@ class SendMessageForm(forms.Form):
         self.fields['recipient'].queryset = User.objects.exclude(pk=self.sender.pk)
 
 
+class BroadcastMessageForm(forms.Form):
+    """
+    Form to send a message to a hospital, all doctors or all nurses
+    """
+    target = forms.TypedChoiceField(choices=BroadcastTarget.get_choices(), coerce=int)
+    hospital = forms.ModelChoiceField(queryset=None, required=False)
+    type = forms.ChoiceField(choices=MessageType.get_choices())
+    message = forms.CharField(widget=forms.Textarea)
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initialize the form
+        :param args: initial arguments
+        :param kwargs: initial kwarguments
+        """
+        self.sender = kwargs.pop('sender')
+
+        super(BroadcastMessageForm, self).__init__(*args, **kwargs)
+
+        self.fields['target'].label = "Send To"
+        self.fields['hospital'].label = "Hospital"
+        self.fields['type'].label = "Message Type"
+        self.fields['message'].label = "Your Message"
+
+        # An administrator can only broadcast to their own hospital
+        self.fields['hospital'].queryset = Hospital.objects.filter(pk=self.sender.get_typed_user().hospital_id)
+
+    def clean(self):
+        """
+        Require a hospital when broadcasting to a hospital
+        :return: The cleaned data
+        """
+        cleaned_data = super(BroadcastMessageForm, self).clean()
+
+        if cleaned_data.get('target') == BroadcastTarget.Hospital and cleaned_data.get('hospital') is None:
+            self.add_error('hospital', "Choose the hospital to send to.")
+
+        return cleaned_data
+
+
 class ReplyMessageForm(forms.Form):
     """
     Form to reply to a message
@@ -1,272 +1,580 @@
 __author__ = "Dakota Baber"
 __email__ = "dakota@mail.rit.edu"
 
-import copy
+import array
+import bisect
+import collections
+import io
 import json
+import tempfile
+import time
 
 from datetime import date as date_type, datetime
 from datetime import datetime as datetime_type
 
 
-class HealthNetImport(object):
+class JSONSectionReader(object):
     """
-    Imports HealthNet data created by other implementations
-    of HealthNet.
+    Reads a JSON object of named sections, e.g. {"hospitals": [...], ...},
+    from a file one record at a time, so only the record being
+    parsed has to fit in memory
     """
 
-    # This will map an arbitrary index to a real pk
-    __pk_map = {
-        'hospitals': {},
-        'admins': {},
-        'doctors': {},
-        'nurses': {},
-        'patients': {},
-    }
+    __decoder = json.JSONDecoder()
 
-    __data = None
+    def __init__(self, fp, chunk_size=64 * 1024):
+        """
+        Initialize the reader
+        :param fp: A file object opened in text mode
+        :param chunk_size: The number of characters to read at a time
+        """
+        self.__fp = fp
+        self.__chunk_size = chunk_size
+        self.__buffer = ''
+        self.__pos = 0
+        self.__eof = False
 
-    # The create_* variables below represent functions that
-    # take the same arguments as their add_* counterparts in
-    # HealthNetExport, however they should return the pk of the
-    # object they created.
-    __create_hospital = None
-    __create_admin = None
-    __create_doctor = None
-    __create_nurse = None
-    __create_patient = None
-    __create_prescription = None
-    __create_test = None
-    __create_appointment = None
-    __create_log = None
+    def __fill(self, size=None):
+        """
+        Read more of the file into the buffer, dropping what has been parsed
+        :param size: The number of characters to read; defaults to the chunk size
+        :return: Whether anything was read
+        """
+        if self.__eof:
+            return False
 
-    def __init__(self, json_data, create_hospital_func=None, create_admin_func=None, create_doctor_func=None,
-                 create_nurse_func=None, create_patient_func=None, create_appointment_func=None,
-                 create_prescription_func=None, create_test_func=None, create_log_func=None):
-        self.__data = json.loads(json_data)
+        chunk = self.__fp.read(size or self.__chunk_size)
+        if not chunk:
+            self.__eof = True
+            return False
 
-        self.__create_hospital = create_hospital_func
-        self.__create_admin = create_admin_func
-        self.__create_doctor = create_doctor_func
-        self.__create_nurse = create_nurse_func
-        self.__create_patient = create_patient_func
-        self.__create_appointment = create_appointment_func
-        self.__create_prescription = create_prescription_func
-        self.__create_test = create_test_func
-        self.__create_log = create_log_func
+        self.__buffer = self.__buffer[self.__pos:] + chunk
+        self.__pos = 0
+        return True
 
-    @staticmethod
-    def __parse_date(timestr):
+    def __peek(self):
         """
-        Parses an iso date to a datetime object
-        :param timestr: ISO 8061 formatted string
-        :return: Datetime object representation of the string
+        Skip whitespace and get the next character without consuming it
+        :return: The next character, or None at the end of the file
         """
+        while True:
+            while self.__pos < len(self.__buffer) and self.__buffer[self.__pos].isspace():
+                self.__pos += 1
+            if self.__pos < len(self.__buffer):
+                return self.__buffer[self.__pos]
+            if not self.__fill():
+                return None
+
+    def __expect(self, chars):
+        """
+        Consume the next character, which must be one of chars
+        :param chars: The characters allowed
+        :return: The character consumed
+        """
+        char = self.__peek()
+        if char is None or char not in chars:
+            raise ValueError("Expected one of '%s' at %r" % (chars, self.__buffer[self.__pos:self.__pos + 20]))
+        self.__pos += 1
+        return char
+
+    def __value(self):
+        """
+        Parse the next complete JSON value, reading more of the file until it fits
+        :return: The value
+        """
+        self.__peek()
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buffer, self.__pos)
+                # A number cut off by the end of the buffer may continue in the next chunk
+                if self.__eof or end < len(self.__buffer) and self.__buffer[end] in ',:]} \t\r\n':
+                    self.__pos = end
+                    return value
+            except ValueError:
+                if self.__eof:
+                    raise
+
+            # Grow by at least the buffer size so a large value isn't reparsed once per chunk
+            self.__fill(max(self.__chunk_size, len(self.__buffer) - self.__pos))
+
+    def __records(self):
+        """
+        Iterate over the records of the current section
+        :return: A generator of records
+        """
+        if self.__peek() != '[':
+            # Not a list; treat the value as the only record
+            yield self.__value()
+            return
+
+        self.__expect('[')
+        if self.__peek() == ']':
+            self.__expect(']')
+            return
 
+        while True:
+            yield self.__value()
+            if self.__expect(',]') == ']':
+                return
+
+    def sections(self):
+        """
+        Iterate over the sections in the order they appear in the file; each
+        section's records must be consumed before moving to the next section
+        :return: A generator of (name, records) tuples
+        """
+        self.__expect('{')
+        if self.__peek() == '}':
+            return
+
+        while True:
+            name = self.__value()
+            self.__expect(':')
+
+            records = self.__records()
+            yield name, records
+
+            # Skip whatever the caller didn't read
+            for _ in records:
+                pass
+
+            if self.__expect(',}') == '}':
+                return
+
+
+def parse_date(timestr):
+    """
+    Parses an iso date to a datetime object
+    :param timestr: ISO 8061 formatted string
+    :return: Datetime object representation of the string
+    """
+
+    try:
+        return datetime.strptime(timestr.split('.')[0].split('+')[0], "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        pass
+    return datetime.strptime(timestr, '%Y-%m-%d')
+
+
+def convert_pk(pk_map, pk_type: str, pk: int):
+    try:
+        real_pk = pk_map[pk_type][pk]
+    except KeyError:
+        return pk
+
+    # Mapped to None when the referenced record failed to import
+    if real_pk is None:
+        raise ValueError('The referenced %s %s failed to import' % (pk_type, pk))
+    return real_pk
+
+
+def convert_pks(pk_map, pk_type: str, pk_list: list):
+    out = []
+    for i in pk_list:
         try:
-            return datetime.strptime(timestr.split('.')[0].split('+')[0], "%Y-%m-%dT%H:%M:%S")
+            out += [convert_pk(pk_map, pk_type, i)]
         except ValueError:
             pass
-        return datetime.strptime(timestr, '%Y-%m-%d')
+    return out
+
+
+# The functions below turn a record of a section into the arguments
+# for its create_* function, mapping the indexes it references to real pks
+
+def prepare_hospital(i, pk_map):
+    return dict(name=i['name'], addr=i['addr'])
+
+
+def prepare_admin(i, pk_map):
+    return dict(username=i['username'], password_hash=i['password_hash'], first_name=i['first_name'],
+                middle_name=i['middle_name'], last_name=i['last_name'], dob=parse_date(i['dob']), addr=i['addr'],
+                email=i['email'], phone=i['phone'],
+                primary_hospital_id=convert_pk(pk_map, 'hospitals', i['primary_hospital_id']),
+                hospital_ids=convert_pks(pk_map, 'hospitals', i['hospital_ids']))
+
+
+def prepare_doctor(i, pk_map):
+    return dict(username=i['username'], password_hash=i['password_hash'], first_name=i['first_name'],
+                middle_name=i['middle_name'], last_name=i['last_name'], dob=parse_date(i['dob']), addr=i['addr'],
+                email=i['email'], phone=i['phone'], hospital_ids=convert_pks(pk_map, 'hospitals', i['hospital_ids']),
+                patient_ids=convert_pks(pk_map, 'patients', i['patient_ids']))
+
+
+def prepare_nurse(i, pk_map):
+    return dict(username=i['username'], password_hash=i['password_hash'], first_name=i['first_name'],
+                middle_name=i['middle_name'], last_name=i['last_name'], dob=parse_date(i['dob']), addr=i['addr'],
+                email=i['email'], phone=i['phone'],
+                primary_hospital_id=convert_pk(pk_map, 'hospitals', i['primary_hospital_id']),
+                doctor_ids=convert_pks(pk_map, 'doctors', i['doctor_ids']))
+
+
+def prepare_patient(i, pk_map):
+    return dict(username=i['username'], password_hash=i['password_hash'], first_name=i['first_name'],
+                middle_name=i['middle_name'], last_name=i['last_name'], dob=parse_date(i['dob']), addr=i['addr'],
+                email=i['email'], phone=i['phone'], emergency_contact=i['emergency_contact'],
+                eye_color=i['eye_color'], bloodtype=i['bloodtype'], weight=i['weight'], height=i['height'],
+                primary_hospital_id=convert_pk(pk_map, 'hospitals', i['primary_hospital_id']),
+                primary_doctor_id=convert_pk(pk_map, 'doctors', i['primary_doctor_id']),
+                doctor_ids=convert_pks(pk_map, 'doctors', i['doctor_ids']))
 
-    def __convert_pk(self, pk_type: str, pk: int):
+
+def prepare_appointment(i, pk_map):
+    return dict(start=parse_date(i['start']), end=parse_date(i['end']), location=i['location'],
+                description=i['description'], doctor_ids=convert_pks(pk_map, 'doctors', i['doctor_ids']),
+                nurse_ids=i['nurse_ids'], patient_ids=convert_pks(pk_map, 'patients', i['patient_ids']))
+
+
+def prepare_prescription(i, pk_map):
+    return dict(name=i['name'], dosage=i['dosage'], notes=i['notes'],
+                doctor_id=convert_pk(pk_map, 'doctors', i['doctor_id']),
+                patient_id=convert_pk(pk_map, 'patients', i['patient_id']))
+
+
+def prepare_test(i, pk_map):
+    return dict(name=i['name'], date=parse_date(i['date']), description=i['description'], results=i['results'],
+                released=i['released'], doctor_id=convert_pk(pk_map, 'doctors', i['doctor_id']),
+                patient_id=convert_pk(pk_map, 'patients', i['patient_id']))
+
+
+def prepare_log_entry(i, pk_map):
+    return dict(user_id=i['user_id'], request_method=i['request_method'], request_secure=i['request_secure'],
+                request_addr=i['request_addr'], description=i['description'],
+                hospital_id=convert_pk(pk_map, 'hospitals', i['hospital_id']))
+
+
+# Each section in the order they are imported, so each only references sections
+# before it, with the function preparing its records and whether the pks of its
+# objects are recorded in the pk map
+IMPORT_SECTIONS = collections.OrderedDict([
+    ('hospitals', (prepare_hospital, True)),
+    ('admins', (prepare_admin, True)),
+    ('doctors', (prepare_doctor, True)),
+    ('nurses', (prepare_nurse, True)),
+    ('patients', (prepare_patient, True)),
+    ('appointments', (prepare_appointment, False)),
+    ('tests', (prepare_test, False)),
+    ('prescriptions', (prepare_prescription, False)),
+    ('log_entries', (prepare_log_entry, False)),
+])
+
+
+def prepare_records(section, records, pk_map):
+    """
+    Prepare a chunk of records
+    :param section: The name of the section the records are from
+    :param records: The records
+    :param pk_map: The pk map converting exported indexes to pks
+    :return: A list of create_* arguments, None for each record that is malformed
+    """
+    prepare = IMPORT_SECTIONS[section][0]
+
+    out = []
+    for i in records:
         try:
-            return self.__pk_map[pk_type][pk]
-        except KeyError:
-            return pk
+            out += [prepare(i, pk_map)]
+        except (KeyError, TypeError, ValueError, AttributeError):
+            out += [None]
+    return out
 
-    def __convert_pks(self, pk_type: str, pk_list: list):
-        out = []
-        for i in pk_list:
-            out += [self.__convert_pk(pk_type, i)]
-        return out
 
-    def import_all(self):
+class HealthNetImport(object):
+    """
+    Imports HealthNet data created by other implementations
+    of HealthNet.
+    """
+
+    # The create_* variables below represent functions that
+    # take the same arguments as their add_* counterparts in
+    # HealthNetExport, however they should return the pk of the
+    # object they created.
+
+    def __init__(self, json_data, create_hospital_func=None, create_admin_func=None, create_doctor_func=None,
+                 create_nurse_func=None, create_patient_func=None, create_appointment_func=None,
+                 create_prescription_func=None, create_test_func=None, create_log_func=None):
         """
-        Import all objects in the JSON file
-        :return: None
+        Initialize the importer
+        :param json_data: The exported JSON, either as a string or as a file object
+                          that is read incrementally as sections are imported
         """
-        self.import_hospitals()
-        self.import_admins()
-        self.import_doctors()
-        self.import_nurses()
-        self.import_patients()
-        self.import_appointments()
-        self.import_tests()
-        self.import_prescriptions()
-        self.import_log_entries()
-
-    def import_hospitals(self):
-        if self.__create_hospital is None:
+        if isinstance(json_data, str):
+            json_data = io.StringIO(json_data)
+
+        self.__data = JSONSectionReader(json_data).sections()
+
+        # Sections read from the file before their turn, spooled to disk
+        self.__spooled = {}
+
+        # This will map an arbitrary index to a real pk
+        self.__pk_map = {section: {} for section, (_, mapped) in IMPORT_SECTIONS.items() if mapped}
+
+        self.__create = {
+            'hospitals': create_hospital_func,
+            'admins': create_admin_func,
+            'doctors': create_doctor_func,
+            'nurses': create_nurse_func,
+            'patients': create_patient_func,
+            'appointments': create_appointment_func,
+            'prescriptions': create_prescription_func,
+            'tests': create_test_func,
+            'log_entries': create_log_func,
+        }
+
+    def __get_section(self, name):
+        """
+        Iterate over the records of a section. Sections can appear in
+        any order in the file; any passed over on the way to this one
+        are written to temporary files to be read when their turn comes.
+        :param name: The name of the section
+        :return: A generator of records
+        """
+        spool = self.__spooled.pop(name, None)
+        if spool is not None:
+            spool.seek(0)
+            for line in spool:
+                yield json.loads(line)
+            spool.close()
             return
 
-        pk_map_index = 0
-        for i in self.__data['hospitals']:
-            try:
-                pk = self.__create_hospital(name=i['name'], addr=i['addr'])
-                self.__pk_map['hospitals'][pk_map_index] = pk
-                pk_map_index += 1
-            except:
-                pass
+        for section, records in self.__data:
+            if section == name:
+                yield from records
+                return
 
-    def import_admins(self):
-        if self.__create_admin is None:
-            return
+            spool = tempfile.TemporaryFile('w+', encoding='utf-8')
+            for record in records:
+                spool.write(json.dumps(record) + '\n')
+            self.__spooled[section] = spool
 
-        pk_map_index = 0
-        for i in self.__data['admins']:
+    def __get_chunks(self, name, chunk_size):
+        """
+        Iterate over the records of a section in chunks
+        :param name: The name of the section
+        :param chunk_size: The number of records per chunk
+        :return: A generator of lists of records
+        """
+        chunk = []
+        for record in self.__get_section(name):
+            chunk += [record]
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def __create_object(self, name, kwargs):
+        """
+        Create one object from its prepared arguments, recording its pk
+        :param name: The name of the section
+        :param kwargs: The arguments for the create_* function; None if the record was malformed
+        :return: Whether the object was created
+        """
+        pk = None
+        created = False
+        if kwargs is not None:
             try:
-                pk = self.__create_admin(username=i['username'], password_hash=i['password_hash'],
-                                         first_name=i['first_name'], middle_name=i['middle_name'],
-                                         last_name=i['last_name'],
-                                         dob=self.__parse_date(i['dob']), addr=i['addr'], email=i['email'],
-                                         phone=i['phone'],
-                                         primary_hospital_id=self.__convert_pk('hospitals', i['primary_hospital_id']),
-                                         hospital_ids=self.__convert_pks('hospitals', i['hospital_ids']))
-                self.__pk_map['admins'][pk_map_index] = pk
-                pk_map_index += 1
+                pk = self.__create[name](**kwargs)
+                created = True
             except:
                 pass
 
-    def import_doctors(self):
-        if self.__create_doctor is None:
+        # Failed records keep their index, mapped to None, so later ones aren't shifted onto the wrong pks
+        if name in self.__pk_map:
+            pk_map = self.__pk_map[name]
+            pk_map[len(pk_map)] = pk if created else None
+        return created
+
+    def __import_section(self, name):
+        """
+        Import every record of a section
+        :param name: The name of the section
+        :return: None
+        """
+        if self.__create[name] is None:
             return
 
-        pk_map_index = 0
-        for i in self.__data['doctors']:
-            try:
-                pk = self.__create_doctor(username=i['username'], password_hash=i['password_hash'],
-                                          first_name=i['first_name'], middle_name=i['middle_name'],
-                                          last_name=i['last_name'],
-                                          dob=self.__parse_date(i['dob']), addr=i['addr'], email=i['email'],
-                                          phone=i['phone'],
-                                          hospital_ids=self.__convert_pks('hospitals', i['hospital_ids']),
-                                          patient_ids=self.__convert_pks('patients', i['patient_ids']))
-                self.__pk_map['doctors'][pk_map_index] = pk
-                pk_map_index += 1
-            except:
-                pass
+        for i in self.__get_section(name):
+            self.__create_object(name, prepare_records(name, [i], self.__pk_map)[0])
 
-    def import_nurses(self):
-        if self.__create_nurse is None:
-            return
+    def import_all(self, chunk_size=500, progress=None):
+        """
+        Import all objects in the JSON file, a section at a time
+        in the order they reference each other
+        :param chunk_size: The number of records read between calls to progress
+        :param progress: A function called with (section, records read, objects created) after each chunk
+        :return: A list of (section, records read, objects created, seconds) tuples, one per section
+        """
+        report = []
+        for name in IMPORT_SECTIONS:
+            if self.__create[name] is None:
+                continue
 
-        pk_map_index = 0
-        for i in self.__data['nurses']:
-            try:
-                pk = self.__create_nurse(username=i['username'], password_hash=i['password_hash'],
-                                         first_name=i['first_name'], middle_name=i['middle_name'],
-                                         last_name=i['last_name'],
-                                         dob=self.__parse_date(i['dob']), addr=i['addr'], email=i['email'],
-                                         phone=i['phone'],
-                                         primary_hospital_id=self.__convert_pk('hospitals', i['primary_hospital_id']),
-                                         doctor_ids=self.__convert_pks('doctors', i['doctor_ids']))
-                self.__pk_map['nurses'][pk_map_index] = pk
-                pk_map_index += 1
-            except:
-                pass
+            read = created = 0
+            start = time.time()
+            for chunk in self.__get_chunks(name, chunk_size):
+                read += len(chunk)
+                created += sum(self.__create_object(name, kwargs)
+                               for kwargs in prepare_records(name, chunk, self.__pk_map))
+                if progress is not None:
+                    progress(name, read, created)
 
-    def import_patients(self):
-        if self.__create_patient is None:
-            return
+            report += [(name, read, created, time.time() - start)]
 
-        pk_map_index = 0
-        for i in self.__data['patients']:
-            try:
-                pk = self.__create_patient(username=i['username'], password_hash=i['password_hash'],
-                                           first_name=i['first_name'], middle_name=i['middle_name'],
-                                           last_name=i['last_name'],
-                                           dob=self.__parse_date(i['dob']), addr=i['addr'], email=i['email'],
-                                           phone=i['phone'], emergency_contact=i['emergency_contact'],
-                                           eye_color=i['eye_color'],
-                                           bloodtype=i['bloodtype'], weight=i['weight'], height=i['height'],
-                                           primary_hospital_id=self.__convert_pk('hospitals', i['primary_hospital_id']),
-                                           primary_doctor_id=self.__convert_pk('doctors', i['primary_doctor_id']),
-                                           doctor_ids=self.__convert_pks('doctors', i['doctor_ids']))
-                self.__pk_map['patients'][pk_map_index] = pk
-                pk_map_index += 1
-            except:
-                pass
+        return report
 
-    def import_appointments(self):
-        if self.__create_appointment is None:
-            return
+    def import_hospitals(self):
+        self.__import_section('hospitals')
 
-        for i in self.__data['appointments']:
-            try:
-                self.__create_appointment(start=self.__parse_date(i['start']), end=self.__parse_date(i['end']),
-                                          location=i['location'], description=i['description'],
-                                          doctor_ids=self.__convert_pks('doctors', i['doctor_ids']),
-                                          nurse_ids=i['nurse_ids'],
-                                          patient_ids=self.__convert_pks('patients', i['patient_ids']))
-            except:
-                pass
+    def import_admins(self):
+        self.__import_section('admins')
 
-    def import_prescriptions(self):
-        if self.__create_prescription is None:
-            return
+    def import_doctors(self):
+        self.__import_section('doctors')
 
-        for i in self.__data['prescriptions']:
-            try:
-                self.__create_prescription(name=i['name'], dosage=i['dosage'], notes=i['notes'],
-                                           doctor_id=self.__convert_pk('doctors', i['doctor_id']),
-                                           patient_id=self.__convert_pk('patients', i['patient_id']))
-            except:
-                pass
+    def import_nurses(self):
+        self.__import_section('nurses')
 
-    def import_tests(self):
-        if self.__create_test is None:
-            return
+    def import_patients(self):
+        self.__import_section('patients')
 
-        for i in self.__data['tests']:
-            try:
-                self.__create_test(name=i['name'], date=self.__parse_date(i['date']), description=i['description'],
-                                   results=i['results'], released=i['released'],
-                                   doctor_id=self.__convert_pk('doctors', i['doctor_id']),
-                                   patient_id=self.__convert_pk('patients', i['patient_id']))
-            except:
-                pass
+    def import_appointments(self):
+        self.__import_section('appointments')
+
+    def import_prescriptions(self):
+        self.__import_section('prescriptions')
+
+    def import_tests(self):
+        self.__import_section('tests')
 
     def import_log_entries(self):
-        if self.__create_log is None:
-            return
+        self.__import_section('log_entries')
 
-        for i in self.__data['log_entries']:
-            try:
-                self.__create_log(user_id=i['user_id'], request_method=i['request_method'],
-                                  request_secure=i['request_secure'],
-                                  request_addr=i['request_addr'], description=i['description'],
-                                  hospital_id=self.__convert_pk('hospitals', i['hospital_id']))
-            except:
-                pass
+
+class PkIndex(object):
+    """
+    Maps real pks to their position in a section, for pks exported
+    in ascending order; a sorted array takes far less memory than a dict
+    """
+
+    def __init__(self, pks):
+        """
+        Initialize the index
+        :param pks: The pks that will be exported
+        """
+        self.__pks = array.array('q', sorted(pks))
+
+    def get(self, pk, default=None):
+        """
+        Get the position of a pk
+        :param pk: The real pk
+        :param default: The value returned if the pk isn't exported
+        :return: The position of the pk
+        """
+        i = bisect.bisect_left(self.__pks, pk)
+        if i < len(self.__pks) and self.__pks[i] == pk:
+            return i
+        return default
 
 
 class HealthNetExport(object):
     """
     Exports HealthNet data to be used by other implementations
-    of HealthNet.
+    of HealthNet. Each object is written out as it is added, so
+    the objects of a section must be added together.
     """
 
-    # This will map a real pk to an arbitrary index
-    __pk_map = {
-        'hospitals': {},
-        'admins': {},
-        'doctors': {},
-        'nurses': {},
-        'patients': {},
-    }
-
-    # The main scheme that will be exported to JSON
-    __export_scheme = {
-        'hospitals': [],
-        'admins': [],
-        'doctors': [],
-        'nurses': [],
-        'patients': [],
-        'appointments': [],
-        'tests': [],
-        'prescriptions': [],
-        'log_entries': [],
-    }
+    SECTIONS = ('hospitals', 'admins', 'doctors', 'nurses', 'patients', 'appointments', 'tests', 'prescriptions',
+                'log_entries')
+
+    def __init__(self, out=None):
+        """
+        Initialize the export
+        :param out: The file to write the JSON to; if None it is kept for export_json
+        """
+        self.__out = out if out is not None else io.StringIO()
+
+        # This will map a real pk to an arbitrary index; see set_pks
+        self.__pk_map = {
+            'hospitals': {},
+            'admins': {},
+            'doctors': {},
+            'nurses': {},
+            'patients': {},
+        }
+
+        self.__section = None
+        self.__written = []
+
+    def set_pks(self, pk_type, pks):
+        """
+        Give the pks of a type before any objects are added, so references
+        to objects of that type can be mapped even before they are written.
+        Objects of the type must then be added in ascending pk order.
+        :param pk_type: The type of object, e.g. 'patients'
+        :param pks: Every pk of that type that will be exported
+        :return: None
+        """
+        self.__pk_map[pk_type] = PkIndex(pks)
+
+    def __add_pk(self, pk_type, pk):
+        """
+        Give the next index of a type to a pk, unless set_pks already did
+        :param pk_type: The type of object
+        :param pk: The real pk
+        :return: None
+        """
+        pk_map = self.__pk_map[pk_type]
+        if isinstance(pk_map, dict):
+            pk_map[pk] = len(pk_map)
+
+    def __map_pk(self, pk_type, pk):
+        """
+        Map a real pk to its index; pks that aren't exported are left as they are
+        :param pk_type: The type of object
+        :param pk: The real pk
+        :return: The index
+        """
+        if pk is None:
+            return None
+        return self.__pk_map[pk_type].get(pk, pk)
+
+    def __map_pks(self, pk_type, pks):
+        """
+        Map a list of real pks to their indexes
+        :param pk_type: The type of object
+        :param pks: The real pks
+        :return: A list of indexes
+        """
+        return [self.__map_pk(pk_type, pk) for pk in pks]
+
+    def __start_section(self, section):
+        """
+        Close the section being written and start another
+        :param section: The name of the section
+        :return: None
+        """
+        if section in self.__written:
+            raise ValueError("The '%s' section was already written; add its objects together" % section)
+
+        if self.__section is not None:
+            self.__out.write(']')
+        self.__out.write('{' if not self.__written else ', ')
+        self.__out.write('%s: [' % json.dumps(section))
+
+        self.__section = section
+        self.__written.append(section)
+
+    def __write(self, section, record):
+        """
+        Write an object to its section
+        :param section: The name of the section
+        :param record: The object
+        :return: None
+        """
+        if section != self.__section:
+            self.__start_section(section)
+        else:
+            self.__out.write(', ')
+        self.__out.write(json.dumps(record))
 
     def add_hospital(self, pk, name: str, addr: str):
         """
@@ -276,11 +584,11 @@ class HealthNetExport(object):
         :param addr: The address of this hospital
         :return: None
         """
-        self.__pk_map['hospitals'][pk] = len(self.__pk_map['hospitals'])
-        self.__export_scheme['hospitals'] += [{
+        self.__add_pk('hospitals', pk)
+        self.__write('hospitals', {
             'name': name,
             'addr': addr
-        }]
+        })
 
     def add_admin(self, pk, username: str, password_hash: str, first_name: str, last_name: str, middle_name: str,
                   dob: date_type, addr: str, email: str, phone: str, primary_hospital_id: int, hospital_ids: list):
@@ -300,8 +608,8 @@ class HealthNetExport(object):
         :param hospital_ids: A list of ids for the hospitals associated with this admin
         :return: None
         """
-        self.__pk_map['admins'][pk] = len(self.__pk_map['admins'])
-        self.__export_scheme['admins'] += [{
+        self.__add_pk('admins', pk)
+        self.__write('admins', {
             'username': username,
             'password_hash': password_hash,
             'first_name': first_name,
@@ -311,9 +619,9 @@ class HealthNetExport(object):
             'addr': addr,
             'email': email,
             'phone': phone,
-            'primary_hospital_id': primary_hospital_id,
-            'hospital_ids': hospital_ids
-        }]
+            'primary_hospital_id': self.__map_pk('hospitals', primary_hospital_id),
+            'hospital_ids': self.__map_pks('hospitals', hospital_ids)
+        })
 
     def add_doctor(self, pk, username: str, password_hash: str, first_name: str, last_name: str, middle_name: str,
                    dob: date_type, addr: str, email: str, phone: str, hospital_ids: list, patient_ids: list):
@@ -333,8 +641,8 @@ class HealthNetExport(object):
         :param patient_ids: A list of patient ids associated with this doctor
         :return: None
         """
-        self.__pk_map['doctors'][pk] = len(self.__pk_map['doctors'])
-        self.__export_scheme['doctors'] += [{
+        self.__add_pk('doctors', pk)
+        self.__write('doctors', {
             'username': username,
             'password_hash': password_hash,
             'first_name': first_name,
@@ -344,9 +652,9 @@ class HealthNetExport(object):
             'addr': addr,
             'email': email,
             'phone': phone,
-            'hospital_ids': hospital_ids,
-            'patient_ids': patient_ids
-        }]
+            'hospital_ids': self.__map_pks('hospitals', hospital_ids),
+            'patient_ids': self.__map_pks('patients', patient_ids)
+        })
 
     def add_nurse(self, pk, username: str, password_hash: str, first_name: str, last_name: str, middle_name: str,
                   dob: date_type, addr: str, email: str, phone: str, primary_hospital_id: list, doctor_ids: list):
@@ -366,8 +674,8 @@ class HealthNetExport(object):
         :param doctor_ids: A lost of doctors ids associated with this nurse
         :return: None
         """
-        self.__pk_map['nurses'][pk] = len(self.__pk_map['nurses'])
-        self.__export_scheme['nurses'] += [{
+        self.__add_pk('nurses', pk)
+        self.__write('nurses', {
             'username': username,
             'password_hash': password_hash,
             'first_name': first_name,
@@ -377,9 +685,9 @@ class HealthNetExport(object):
             'addr': addr,
             'email': email,
             'phone': phone,
-            'primary_hospital_id': primary_hospital_id,
-            'doctor_ids': doctor_ids
-        }]
+            'primary_hospital_id': self.__map_pk('hospitals', primary_hospital_id),
+            'doctor_ids': self.__map_pks('doctors', doctor_ids)
+        })
 
     def add_patient(self, pk, username: str, password_hash: str, first_name: str, middle_name: str, last_name: str,
                     dob: date_type, addr: str, email: str, phone: str, emergency_contact: str, eye_color: str,
@@ -407,8 +715,8 @@ class HealthNetExport(object):
         :param doctor_ids: A list of doctor ids associated with this patient
         :return: None
         """
-        self.__pk_map['patients'][pk] = len(self.__pk_map['patients'])
-        self.__export_scheme['patients'] += [{
+        self.__add_pk('patients', pk)
+        self.__write('patients', {
             'username': username,
             'password_hash': password_hash,
             'first_name': first_name,
@@ -423,10 +731,10 @@ class HealthNetExport(object):
             'bloodtype': bloodtype,
             'height': height,
             'weight': weight,
-            'primary_hospital_id': primary_hospital_id,
-            'primary_doctor_id': primary_doctor_id,
-            'doctor_ids': doctor_ids
-        }]
+            'primary_hospital_id': self.__map_pk('hospitals', primary_hospital_id),
+            'primary_doctor_id': self.__map_pk('doctors', primary_doctor_id),
+            'doctor_ids': self.__map_pks('doctors', doctor_ids)
+        })
 
     def add_appointment(self, start: datetime_type, end: datetime_type, location: str, description: str,
                         doctor_ids: list, nurse_ids: list, patient_ids: list):
@@ -441,15 +749,15 @@ class HealthNetExport(object):
         :param patient_ids: A list of ids of the patients attending
         :return: None
         """
-        self.__export_scheme['appointments'] += [{
+        self.__write('appointments', {
             'start': start.isoformat(),
             'end': end.isoformat(),
             'location': location,
             'description': description,
-            'doctor_ids': doctor_ids,
-            'nurse_ids': nurse_ids,
-            'patient_ids': patient_ids
-        }]
+            'doctor_ids': self.__map_pks('doctors', doctor_ids),
+            'nurse_ids': self.__map_pks('nurses', nurse_ids),
+            'patient_ids': self.__map_pks('patients', patient_ids)
+        })
 
     def add_prescription(self, name: str, dosage: int, notes: str, doctor_id: int, patient_id: int):
         """
@@ -461,13 +769,13 @@ class HealthNetExport(object):
         :param patient_id: The id of the patient associated with the prescription
         :return: None
         """
-        self.__export_scheme['prescriptions'] += [{
+        self.__write('prescriptions', {
             'name': name,
             'dosage': dosage,
             'notes': notes,
-            'doctor_id': doctor_id,
-            'patient_id': patient_id
-        }]
+            'doctor_id': self.__map_pk('doctors', doctor_id),
+            'patient_id': self.__map_pk('patients', patient_id)
+        })
 
     def add_test(self, name: str, date: date_type, description: str, results: str, released: bool, doctor_id: int,
                  patient_id: int):
@@ -482,15 +790,15 @@ class HealthNetExport(object):
         :param patient_id: The id of the patient associated with this test
         :return: None
         """
-        self.__export_scheme['tests'] += [{
+        self.__write('tests', {
             'name': name,
             'date': date.isoformat(),
             'description': description,
             'results': results,
             'released': released,
-            'doctor_id': doctor_id,
-            'patient_id': patient_id
-        }]
+            'doctor_id': self.__map_pk('doctors', doctor_id),
+            'patient_id': self.__map_pk('patients', patient_id)
+        })
 
     def add_log_entry(self, user_id: int, request_method: str, request_secure: bool, request_addr: str,
                       description: str, hospital_id: int):
@@ -504,125 +812,31 @@ class HealthNetExport(object):
         :param hospital_id: The ID of the hospital this log entry is referencing
         :return: None
         """
-        self.__export_scheme['log_entries'] += [{
+        self.__write('log_entries', {
             'user_id': user_id,
             'request_method': request_method,
             'request_secure': request_secure,
             'request_addr': request_addr,
             'description': description,
-            'hospital_id': hospital_id
-        }]
-
-    def export_json(self):
-        """
-        Export the added models to a JSON string
-        :return: a JSON string representing the added data
-        """
-        # Go through each object type and link them to their new pk_map ids
-        # this will error if a nonexistent link attempt is made
-        output_schema = copy.deepcopy(self.__export_scheme)
+            'hospital_id': self.__map_pk('hospitals', hospital_id)
+        })
 
-        # Admin pk_map
-        for i in range(len(output_schema['admins'])):
-            self.set_pk_for_field(output_schema, 'admins', i, 'hospitals', 'primary_hospital_id')
-
-            for j in range(len(output_schema['admins'][i]['hospital_ids'])):
-                self.set_pk_for_field_with_idx(output_schema, 'admins', i, 'hospitals', 'hospital_ids', j)
-
-        # Patient pk_map
-        for i in range(len(output_schema['patients'])):
-            self.set_pk_for_field(output_schema, 'patients', i, 'hospitals', 'primary_hospital_id')
-            self.set_pk_for_field(output_schema, 'patients', i, 'doctors', 'primary_doctor_id')
-
-            for j in range(len(output_schema['patients'][i]['doctor_ids'])):
-                self.set_pk_for_field_with_idx(output_schema, 'patients', i, 'doctors', 'doctor_ids', j)
-
-        # Doctor pk_map
-        for i in range(len(output_schema['doctors'])):
-            for j in range(len(output_schema['doctors'][i]['patient_ids'])):
-                self.set_pk_for_field_with_idx(output_schema, 'doctors', i, 'patients', 'patient_ids', j)
-
-            for j in range(len(output_schema['doctors'][i]['hospital_ids'])):
-                self.set_pk_for_field_with_idx(output_schema, 'doctors', i, 'hospitals', 'hospital_ids', j)
-
-        # Nurse pk_map
-        for i in range(len(output_schema['nurses'])):
-            self.set_pk_for_field(output_schema, 'nurses', i, 'hospitals', 'primary_hospital_id')
-
-            for j in range(len(output_schema['nurses'][i]['doctor_ids'])):
-                self.set_pk_for_field_with_idx(output_schema, 'nurses', i, 'doctors', 'doctor_ids', j)
-
-        # Patient pk_map
-        for i in range(len(output_schema['patients'])):
-            self.set_pk_for_field(output_schema, 'patients', i, 'hospitals', 'primary_hospital_id')
-            self.set_pk_for_field(output_schema, 'patients', i, 'doctors', 'primary_doctor_id')
-
-            for j in range(len(output_schema['patients'][i]['doctor_ids'])):
-                self.set_pk_for_field_with_idx(output_schema, 'patients', i, 'doctors', 'doctor_ids', j)
-
-        # Appointment pk_map
-        for i in range(len(output_schema['appointments'])):
-            for j in range(len(output_schema['appointments'][i]['doctor_ids'])):
-                self.set_pk_for_field_with_idx(output_schema, 'appointments', i, 'doctors', 'doctor_ids', j)
-
-            for j in range(len(output_schema['appointments'][i]['patient_ids'])):
-                self.set_pk_for_field_with_idx(output_schema, 'appointments', i, 'patients', 'patient_ids', j)
-
-            for j in range(len(output_schema['appointments'][i]['nurse_ids'])):
-                self.set_pk_for_field_with_idx(output_schema, 'appointments', i, 'nurses', 'nurse_ids', j)
-
-        # Prescription pk_map
-        for i in range(len(output_schema['prescriptions'])):
-            self.set_pk_for_field(output_schema, 'prescriptions', i, 'patients', 'patient_id')
-            self.set_pk_for_field(output_schema, 'prescriptions', i, 'doctors', 'doctor_id')
-
-        # Tests pk_map
-        for i in range(len(output_schema['tests'])):
-            self.set_pk_for_field(output_schema, 'tests', i, 'patients', 'patient_id')
-            self.set_pk_for_field(output_schema, 'tests', i, 'doctors', 'doctor_id')
-
-        # Logs pk_map
-        for i in range(len(output_schema['log_entries'])):
-            self.set_pk_for_field(output_schema, 'log_entries', i, 'hospitals', 'hospital_id')
-
-        # return the json string
-        return json.dumps(output_schema)
-
-    def set_pk_for_field_with_idx(self, schema_map, schema_key, schema_index, pk_key, key_to_replace, idx):
+    def close(self):
         """
-        Maps a real pk to its arbitrary index in an array
-        :param schema_map: The schema map
-        :param schema_key: The key of the item in the schema
-        :param schema_index: The index of the item in the schema
-        :param pk_key: The key to look up the new pk in
-        :param key_to_replace: The key to replace the pk for
-        :param idx: The index of the item in the array
+        Finish the JSON, writing an empty list for each section nothing was added to
         :return: None
         """
-        if schema_map[schema_key][schema_index][key_to_replace][idx] is None:
-            return
+        for section in self.SECTIONS:
+            if section not in self.__written:
+                self.__start_section(section)
 
-        try:
-            schema_map[schema_key][schema_index][key_to_replace][idx] = self.__pk_map[pk_key][
-                schema_map[schema_key][schema_index][key_to_replace][idx]]
-        except KeyError:
-            pass
+        self.__out.write(']}')
+        self.__section = None
 
-    def set_pk_for_field(self, schema_map, schema_key, schema_index, pk_key, key_to_replace):
+    def export_json(self):
         """
-        Maps a real pk to its arbitrary index
-        :param schema_map: The schema map
-        :param schema_key: The key of the item in the schema
-        :param schema_index: The index of the item in the schema
-        :param pk_key: The key to look up the new pk in
-        :param key_to_replace: The key to replace the pk for
-        :return: None
+        Export the added models to a JSON string, when no file was given
+        :return: a JSON string representing the added data
         """
-        if schema_map[schema_key][schema_index][key_to_replace] is None:
-            return
-
-        try:
-            schema_map[schema_key][schema_index][key_to_replace] = self.__pk_map[pk_key][
-                schema_map[schema_key][schema_index][key_to_replace]]
-        except KeyError:
-            pass
+        self.close()
+        return self.__out.getvalue()
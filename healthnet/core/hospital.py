@@ -1,6 +1,9 @@
-import operator
+import collections
+import json
+from datetime import timedelta
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Avg, Case, Count, F, IntegerField, Sum, When
 
 from healthnet.core.users.patient import Patient
 from healthnet.models import States
@@ -18,6 +21,11 @@ class Hospital(models.Model):
     state = models.IntegerField(choices=States.get_choices())
     zipcode = models.CharField(max_length=5)
 
+    # Running totals of completed visits; see Admission.discharge
+    visit_count = models.IntegerField(default=0)
+    visit_length_sum = models.BigIntegerField(default=0)  # seconds
+    visit_length_sumsq = models.BigIntegerField(default=0)  # seconds squared
+
     def get_doctors(self):
         """
         Get all doctors in this hospital
@@ -38,45 +46,52 @@ class Hospital(models.Model):
         Get the average number of visits and the average visit length
         :return: A tuple of the average number of visits and the length
         """
-        pats = self.get_patients()
+        rows = self.get_patients().order_by('pk').values_list('visits', 'average_visit_length')
         visits, length = [], []
-        for p in pats:
-            visits += [p.visits]
-            length += [p.average_visit_length]
+        for v, l in rows:
+            visits += [v]
+            length += [l]
         return visits, length
 
     def get_popular_prescriptions(self):
         """
         Get popular prescriptions for this hospital
-        :return: A dictionary representing prescriptions and the number of times issued
+        :return: A list of prescription names and the number of times issued, least issued first
         """
-        pats = self.get_patients().all()
-        names = {}
-        for pat in pats:
-            for p in pat.get_prescriptions():
-                if p.name not in names:
-                    names[p.name] = 0
-                names[p.name] += 1
-        return sorted(names.items(), key=operator.itemgetter(1))
+        from healthnet.core.prescription import Prescription
+        return list(Prescription.objects.filter(patient__hospital=self).values_list('name')
+                    .annotate(count=Count('pk')).order_by('count', 'name'))
 
     def get_average_prescription_length(self):
         """
         Gets the average length of prescriptions at this hospital
         :return: The average length of prescriptions
         """
-        pats = self.get_patients().all()
+        from healthnet.core.prescription import Prescription
+
+        # Grouped by date pair, so the rows read grow with the days covered rather than the prescriptions
+        rows = Prescription.objects.filter(patient__hospital=self).values_list('issue_date', 'expiration_date') \
+            .annotate(count=Count('pk')).order_by()
         sum = 0
         count = 0
-        for pat in pats:
-            for p in pat.get_prescriptions():
-                sum += (p.expiration_date - p.issue_date).total_seconds()
-                count += 1
+        for issue_date, expiration_date, num in rows.iterator():
+            sum += (expiration_date - issue_date).total_seconds() * num
+            count += num
 
         if count == 0:
             return 0
 
         return sum / count
 
+    def get_visit_length_stats(self):
+        """
+        Get the mean and standard deviation of visit lengths at this hospital
+        :return: A tuple of the mean and standard deviation in seconds
+        """
+        from healthnet.core.admission import RunningStats
+        return (RunningStats.mean(self.visit_count, self.visit_length_sum),
+                RunningStats.stddev(self.visit_count, self.visit_length_sum, self.visit_length_sumsq))
+
     def has_user(self, user):
         """
         Checks if a hospital is associated with a user
@@ -116,3 +131,191 @@ class Hospital(models.Model):
         :return: The string representation of the object
         """
         return self.__unicode__()
+
+
+class HospitalStats(object):
+    """
+    Everything the statistics page shows about a hospital, computed with
+    aggregate queries so neither the queries nor the page grow with the
+    number of patients; see get_patients_page for the patient table
+    """
+
+    @staticmethod
+    def get(hospital, num_prescriptions=5):
+        """
+        Get the statistics for a hospital
+        :param hospital: The hospital
+        :param num_prescriptions: The number of most issued prescriptions to include
+        :return: A dictionary of statistics for the statistics page
+        """
+        from healthnet.core.admission import Admission, VisitLengthBucket
+
+        patients = hospital.get_patients()
+
+        counts = patients.aggregate(
+                number_patients=Count('pk'),
+                num_patients_admitted=Sum(Case(When(is_admitted=True, then=1), default=0, output_field=IntegerField())),
+                average_visits=Avg('visits'),
+                average_visit_length=Avg('average_visit_length'))
+        number_patients = counts['number_patients']
+        num_patients_admitted = counts['num_patients_admitted'] or 0
+
+        # Patients by number of visits, and completed visits by length in hours
+        visits = list(patients.values_list('visits').annotate(count=Count('pk')).order_by('visits'))
+        hours = collections.Counter()
+        for bucket, count in VisitLengthBucket.objects.filter(hospital=hospital, count__gt=0) \
+                .values_list('bucket', 'count'):
+            hours[VisitLengthBucket.get_length(bucket) // 3600] += count
+
+        popular_scripts = hospital.get_popular_prescriptions()[::-1][:num_prescriptions]
+
+        mean, stddev = hospital.get_visit_length_stats()
+        median = Admission.get_length_percentile(hospital, 0.5)
+        p90 = Admission.get_length_percentile(hospital, 0.9)
+
+        return {
+            'number_patients': number_patients,
+            'num_patients_admitted': num_patients_admitted,
+            'num_patients_discharged': number_patients - num_patients_admitted,
+            'average_visits': counts['average_visits'] or 0,
+            'average_visit_length': timedelta(seconds=int(counts['average_visit_length'] or 0)),
+            'visits_labels_json': json.dumps([v for v, _ in visits]),
+            'visits_values_json': json.dumps([count for _, count in visits]),
+            'visit_length_labels_json': json.dumps(sorted(hours)),
+            'visit_length_values_json': json.dumps([hours[h] for h in sorted(hours)]),
+            'popular_scripts_names_json': json.dumps([p[0] for p in popular_scripts]),
+            'popular_scripts_values_json': json.dumps([p[1] for p in popular_scripts]),
+            'average_script_length': hospital.get_average_prescription_length(),
+            'visit_count': hospital.visit_count,
+            'visit_length_mean': timedelta(seconds=int(mean)),
+            'visit_length_stddev': timedelta(seconds=int(stddev)),
+            'visit_length_median': timedelta(seconds=median) if median is not None else None,
+            'visit_length_p90': timedelta(seconds=p90) if p90 is not None else None,
+        }
+
+    @staticmethod
+    def get_patients_page(hospital, before=None, per_page=50):
+        """
+        Get a page of the patient table on the statistics page
+        :param hospital: The hospital
+        :param before: The cursor of the previous page; None for the first page
+        :param per_page: The number of patients on each page
+        :return: A tuple of the patients on the page and the cursor for the next page
+        """
+        from healthnet.core.pagination import KeysetPaginator
+
+        patients = hospital.get_patients().only('first_name', 'last_name', 'visits', 'average_visit_length',
+                                                'is_admitted', 'last_admit_date')
+        return KeysetPaginator(patients, 'pk', per_page).page(before)
+
+
+class HospitalDailyStats(models.Model):
+    """
+    Admissions and discharges at a hospital on one day, kept up
+    to date as patients are admitted, discharged and transferred
+    """
+    hospital = models.ForeignKey('Hospital')
+    date = models.DateField()
+    admissions = models.IntegerField(default=0)
+    discharges = models.IntegerField(default=0)
+    total_visit_length = models.IntegerField(default=0)  # seconds, of the visits that ended this day
+
+    class Meta:
+        """
+        Meta class
+        """
+        unique_together = [('hospital', 'date')]
+
+    @staticmethod
+    def add(hospital_id, date, **counts):
+        """
+        Add to the counts of a hospital for a day
+        :param hospital_id: The pk of the hospital
+        :param date: The day
+        :param counts: The amount to add to each count, e.g. admissions=1
+        :return: None
+        """
+        add_counts(HospitalDailyStats, {'hospital_id': hospital_id, 'date': date}, counts)
+
+    @staticmethod
+    def get_range(hospital, start, end):
+        """
+        Get the statistics of a hospital over a range of days
+        :param hospital: The hospital
+        :param start: The first day
+        :param end: The last day
+        :return: A dictionary of statistics for the statistics page
+        """
+        rows = HospitalDailyStats.objects.filter(hospital=hospital, date__gte=start, date__lte=end)
+        by_date = {date: (admissions, discharges) for date, admissions, discharges in
+                   rows.values_list('date', 'admissions', 'discharges')}
+        totals = rows.aggregate(admissions=Sum('admissions'), discharges=Sum('discharges'),
+                                total_visit_length=Sum('total_visit_length'))
+        discharges = totals['discharges'] or 0
+
+        scripts = list(HospitalDailyPrescriptions.objects.filter(hospital=hospital, date__gte=start, date__lte=end)
+                       .values_list('name').annotate(total=Sum('count')).order_by('-total', 'name')[:5])
+
+        # One point per day, including days nothing happened
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+        return {
+            'range_admissions': totals['admissions'] or 0,
+            'range_discharges': discharges,
+            'range_average_visit_length': timedelta(
+                    seconds=(totals['total_visit_length'] or 0) // discharges if discharges else 0),
+            'trend_labels_json': json.dumps([d.isoformat() for d in days]),
+            'trend_admissions_json': json.dumps([by_date.get(d, (0, 0))[0] for d in days]),
+            'trend_discharges_json': json.dumps([by_date.get(d, (0, 0))[1] for d in days]),
+            'range_scripts_names_json': json.dumps([s[0] for s in scripts]),
+            'range_scripts_values_json': json.dumps([s[1] for s in scripts]),
+        }
+
+
+class HospitalDailyPrescriptions(models.Model):
+    """
+    The number of prescriptions of a name issued at a hospital on one day
+    """
+    hospital = models.ForeignKey('Hospital')
+    date = models.DateField()
+    name = models.CharField(max_length=255)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        """
+        Meta class
+        """
+        unique_together = [('hospital', 'date', 'name')]
+
+    @staticmethod
+    def add(hospital_id, date, name, count=1):
+        """
+        Add to the number of prescriptions issued
+        :param hospital_id: The pk of the hospital
+        :param date: The day they were issued
+        :param name: The name of the prescription
+        :param count: The number issued
+        :return: None
+        """
+        add_counts(HospitalDailyPrescriptions, {'hospital_id': hospital_id, 'date': date, 'name': name},
+                   {'count': count})
+
+
+def add_counts(model, key, counts):
+    """
+    Atomically add to the counts of a snapshot row, creating it if it doesn't exist
+    :param model: The snapshot model
+    :param key: The fields identifying the row
+    :param counts: The amount to add to each count
+    :return: None
+    """
+    increments = {field: F(field) + amount for field, amount in counts.items()}
+    if model.objects.filter(**key).update(**increments):
+        return
+
+    try:
+        with transaction.atomic():
+            model.objects.create(**dict(key, **counts))
+    except IntegrityError:
+        # Someone else created it first
+        model.objects.filter(**key).update(**increments)
@@ -0,0 +1,48 @@
+import random
+import string
+
+from django.db import DEFAULT_DB_ALIAS
+
+from healthnet.core.users.patient import Patient
+
+
+class InsuranceNumberGenerator(object):
+    """
+    Hands out health insurance numbers no patient has, checking
+    against numbers loaded once instead of querying for each one
+    """
+
+    FIRST_CHARS = string.ascii_uppercase
+    OTHER_CHARS = string.ascii_uppercase + string.digits
+    LENGTH = 12
+
+    def __init__(self, existing=None, using=DEFAULT_DB_ALIAS):
+        """
+        Initialize the generator
+        :param existing: The numbers already taken; loaded from the database if None
+        :param using: The database to load taken numbers from
+        """
+        if existing is None:
+            existing = Patient.objects.using(using).values_list('health_insurance_number', flat=True).iterator()
+        self.taken = set(existing)
+
+    def next(self):
+        """
+        Get a new unique insurance number, a letter followed by
+        eleven letters or digits
+        :return: The insurance number
+        """
+        while True:
+            num = random.choice(self.FIRST_CHARS) + ''.join(
+                    [random.choice(self.OTHER_CHARS) for _ in range(self.LENGTH - 1)])
+            if num not in self.taken:
+                self.taken.add(num)
+                return num
+
+    def batch(self, n):
+        """
+        Get several new unique insurance numbers
+        :param n: The number of insurance numbers
+        :return: A list of insurance numbers
+        """
+        return [self.next() for _ in range(n)]
@@ -1,5 +1,11 @@
+import atexit
+import queue
+import threading
+import time
+
 import django
-from django.db import models
+from django.conf import settings
+from django.db import connection, models
 
 from healthnet.core.enumfield import EnumField
 
@@ -10,10 +16,17 @@ class LogEntry(models.Model):
     """
     A log entry which is logged by the log, and created automatically through system interactions
     """
-    datetime = models.DateTimeField()
+    datetime = models.DateTimeField(db_index=True)
     level = models.IntegerField(choices=LogLevel.get_choices(), default=LogLevel.Info)
     message = models.TextField()
 
+    class Meta:
+        """
+        Meta class
+        """
+        # The log page is read newest first by (datetime, pk), optionally for one level
+        index_together = [('level', 'datetime', 'id')]
+
     def get_level_str(self):
         """
         Gets the level of the log entry
@@ -29,11 +42,257 @@ class LogEntry(models.Model):
             return 'Unknown'
 
 
+class LogRollup(models.Model):
+    """
+    The number of log entries of a level on a day, kept for
+    entries that have been archived and pruned from the log
+    """
+    date = models.DateField()
+    level = models.IntegerField(choices=LogLevel.get_choices(), default=LogLevel.Info)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        """
+        Meta class
+        """
+        unique_together = [('date', 'level')]
+
+    @staticmethod
+    def add(date, level, count):
+        """
+        Add to the count for a day and level
+        :param date: The day of the entries
+        :param level: The level of the entries
+        :param count: The number of entries
+        :return: None
+        """
+        if not LogRollup.objects.filter(date=date, level=level).update(count=models.F('count') + count):
+            LogRollup.objects.create(date=date, level=level, count=count)
+
+
+class LogWriter(object):
+    """
+    Buffers log entries in a bounded queue and writes them in batches
+    from a background thread so requests don't each wait on an INSERT
+    """
+
+    # Attempts at writing a batch at once before its entries are saved one at a time
+    RETRIES = 3
+
+    def __init__(self, flush_interval=0.5, batch_size=100, max_queue_size=10000, put_timeout=5):
+        """
+        Initialize the writer; the background thread starts with the first entry
+        :param flush_interval: The most seconds an entry waits before it is written
+        :param batch_size: The most entries written per INSERT
+        :param max_queue_size: The most entries buffered before callers block
+        :param put_timeout: The most seconds a caller blocks on a full buffer before writing its entry itself
+        """
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.write_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+        # Once per writer; flush stops the thread, so it may be started again
+        atexit.register(self.flush)
+
+    def start(self):
+        """
+        Start the background thread if it isn't running
+        :return: None
+        """
+        with self.start_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+
+            self.thread = threading.Thread(target=self.run, name='healthnet-log-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, entry):
+        """
+        Buffer an entry to be written; blocks while the buffer is full
+        :param entry: The unsaved LogEntry
+        :return: None
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+
+        try:
+            self.queue.put(entry, timeout=self.put_timeout)
+        except queue.Full:
+            # The writer can't keep up; don't lose the entry
+            self.save([entry])
+            return
+
+        # A flush may have stopped the thread before it saw the entry
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+
+    def run(self):
+        """
+        Write batches until flush stops the thread and the buffer is empty
+        :return: None
+        """
+        try:
+            while True:
+                entries = self.take(self.batch_size)
+                if entries:
+                    self.save(entries)
+                elif self.stopping.is_set():
+                    return
+        finally:
+            # The thread has its own connection; don't leave it open
+            connection.close()
+
+    def take(self, count):
+        """
+        Wait for the first entry, then collect up to count entries
+        or whatever arrives before the flush interval is up
+        :param count: The most entries to take
+        :return: A list of entries, empty if none arrived in time
+        """
+        entries = []
+        try:
+            entries.append(self.queue.get(timeout=self.flush_interval))
+            deadline = time.time() + self.flush_interval
+            while len(entries) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                entries.append(self.queue.get(timeout=remaining))
+        except queue.Empty:
+            pass
+        return entries
+
+    def save(self, entries):
+        """
+        Write a batch of entries with one INSERT, retrying on a new
+        connection and then saving the entries one at a time
+        :param entries: The entries to write
+        :return: None
+        """
+        with self.write_lock:
+            for attempt in range(self.RETRIES):
+                try:
+                    LogEntry.objects.bulk_create(entries, batch_size=self.batch_size)
+                    return
+                except Exception:
+                    # Drop a broken connection so the next attempt reconnects
+                    connection.close()
+                    time.sleep(0.1 * 2 ** attempt)
+
+            # Only lose the entries that can't be written on their own
+            for entry in entries:
+                try:
+                    entry.save()
+                except Exception as e:
+                    print('Failed to write log entry %r: %s' % (entry.message, e))
+                    connection.close()
+
+    def flush(self):
+        """
+        Write everything that is buffered now; the background thread
+        finishes its current batch and everything queued, then stops
+        until the next entry is written
+        :return: None
+        """
+        with self.start_lock:
+            thread = self.thread
+            if thread is not None and thread.is_alive():
+                self.stopping.set()
+                thread.join()
+            self.stopping.clear()
+            self.thread = None
+
+        # Whatever was written while the thread was stopping
+        entries = []
+        while True:
+            try:
+                entries.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if entries:
+            self.save(entries)
+
+
 class Logging(object):
     """
     The log
     """
 
+    # The LogWriter used when HEALTHNET_LOG_BUFFERED is on; see get_writer
+    writer = None
+    writer_lock = threading.Lock()
+
+    @staticmethod
+    def get_writer():
+        """
+        Get the buffered writer, or None if entries are saved as they are logged
+        :return: The LogWriter or None
+        """
+        if not getattr(settings, 'HEALTHNET_LOG_BUFFERED', False):
+            return None
+
+        if Logging.writer is None:
+            with Logging.writer_lock:
+                if Logging.writer is None:
+                    Logging.writer = LogWriter(
+                            flush_interval=getattr(settings, 'HEALTHNET_LOG_FLUSH_INTERVAL', 500) / 1000,
+                            batch_size=getattr(settings, 'HEALTHNET_LOG_BATCH_SIZE', 100),
+                            max_queue_size=getattr(settings, 'HEALTHNET_LOG_QUEUE_SIZE', 10000))
+        return Logging.writer
+
+    @staticmethod
+    def flush():
+        """
+        Write any buffered log entries now
+        :return: None
+        """
+        if Logging.writer is not None:
+            Logging.writer.flush()
+
+    @staticmethod
+    def get_entries(start=None, end=None, level=None, text=None):
+        """
+        Get the log entries matching the log page filters
+        :param start: Only entries after this datetime, if given
+        :param end: Only entries before this datetime, if given
+        :param level: Only entries of this LogLevel, if given
+        :param text: Only entries whose message contains this text, if given
+        :return: A queryset of log entries
+        """
+        entries = LogEntry.objects.all()
+        if start is not None:
+            entries = entries.filter(datetime__gt=start)
+        if end is not None:
+            entries = entries.filter(datetime__lt=end)
+        if level is not None:
+            entries = entries.filter(level=level)
+        if text:
+            entries = entries.filter(message__icontains=text)
+        return entries
+
+    @staticmethod
+    def get_archived_counts(start=None, end=None):
+        """
+        Get how many entries of each level have been archived
+        :param start: Only days on or after this date, if given
+        :param end: Only days on or before this date, if given
+        :return: A list of (level name, count) tuples
+        """
+        rollups = LogRollup.objects.all()
+        if start is not None:
+            rollups = rollups.filter(date__gte=start)
+        if end is not None:
+            rollups = rollups.filter(date__lte=end)
+
+        counts = dict(rollups.values_list('level').annotate(total=models.Sum('count')))
+        return [(name, counts[level]) for level, name in LogLevel.get_choices() if counts.get(level)]
+
     @staticmethod
     def log(level, msg, print_stdout=True):
         """
@@ -46,7 +305,12 @@ class Logging(object):
         entry = LogEntry(message=msg, level=level, datetime=time)
         if print_stdout:
             print('%s: [%s] %s' % (entry.datetime.strftime("%Y-%m-%d %H:%M"), entry.get_level_display(), entry.message))
-        entry.save()
+
+        writer = Logging.get_writer()
+        if writer is None:
+            entry.save()
+        else:
+            writer.write(entry)
 
     @staticmethod
     def error(msg, print_stdout=True):
@@ -1,10 +1,12 @@
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models, transaction
 from django.utils.html import linebreaks
 
 from healthnet.core.enumfield import EnumField
 from vendor.markdown2 import markdown
 
 MessageType = EnumField('Normal', 'Emergency', 'Reminder', 'Call to Action')
+BroadcastTarget = EnumField('Hospital', 'Doctors', 'Nurses')
 
 
 class Message(models.Model):
@@ -19,22 +21,71 @@ class Message(models.Model):
     is_read = models.BooleanField(default=False)
     is_notification = models.BooleanField(default=False)
     date = models.DateTimeField(auto_now_add=True, blank=True)
+    html = models.TextField(blank=True, default='')  # text rendered by render_html
 
-    def get_html(self):
+    # The furthest back a thread is followed, in case of a cycle
+    MAX_THREAD_DEPTH = 1000
+
+    class Meta:
+        """
+        Meta class
         """
-        Get the HTML for a message while stripping
+        # Inbox and sent pages are read newest first by (date, pk)
+        index_together = [('recipient', 'date', 'id'), ('sender', 'date', 'id')]
+
+    @staticmethod
+    def render_html(text):
+        """
+        Render message text to HTML while stripping
         excessive line breaks and converting markdown
+        :param text: The message text
+        :return: The HTML for the text
+        """
+        return linebreaks(markdown(text.rstrip()).rstrip())
+
+    def get_html(self):
+        """
+        Get the HTML for a message, rendering it only if
+        it was not stored when the message was saved
         :return: The HTML for this message
         """
-        return linebreaks(markdown(self.text.rstrip()).rstrip())
+        if not self.html:
+            self.html = Message.render_html(self.text)
+        return self.html
+
+    def save(self, *args, **kwargs):
+        """
+        Save the message, rendering its HTML whenever the text is saved
+        :param args: arguments to Model.save
+        :param kwargs: kwarguments to Model.save
+        :return: None
+        """
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'text' in update_fields:
+            self.html = Message.render_html(self.text)
+            if update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + ['html']
+        super(Message, self).save(*args, **kwargs)
+        UnreadCounter.invalidate(self.recipient_id)
+
+    def delete(self, *args, **kwargs):
+        """
+        Delete the message
+        :param args: arguments to Model.delete
+        :param kwargs: kwarguments to Model.delete
+        :return: None
+        """
+        super(Message, self).delete(*args, **kwargs)
+        UnreadCounter.invalidate(self.recipient_id)
 
     def toggle_unread(self):
         """
         Toggle the messages read state
         :return: None
         """
+        Message.objects.filter(pk=self.pk).update(is_read=not self.is_read)
+        UnreadCounter.invalidate(self.recipient_id)
         self.is_read = not self.is_read
-        self.save()
 
     def get_read_status_str(self, invert=False):
         """
@@ -57,14 +108,26 @@ class Message(models.Model):
     def get_previous_messages(self):
         """
         Get the messages that this message was a reply to
+        with a recursive query that walks the whole thread at once
         :return: A list of messages in the order the where sent
         """
-        messages = [self]
-        message = self
-        while message.previous_message is not None:
-            messages += [message.previous_message]
-            message = message.previous_message
-        messages.reverse()
+        table = connection.ops.quote_name(Message._meta.db_table)
+        messages = list(Message.objects.raw(
+            'WITH RECURSIVE thread(id, depth) AS ('
+            '    SELECT id, 0 FROM {table} WHERE id = %s'
+            '    UNION ALL'
+            '    SELECT m.previous_message_id, thread.depth + 1 FROM {table} m JOIN thread ON m.id = thread.id'
+            '    WHERE m.previous_message_id IS NOT NULL AND thread.depth < %s'
+            ') SELECT {table}.* FROM {table} JOIN thread ON {table}.id = thread.id'
+            ' ORDER BY thread.depth DESC'.format(table=table), [self.pk, Message.MAX_THREAD_DEPTH]))
+
+        # Load everyone in the thread in one query instead of once per message
+        from healthnet.core.users.user import User
+        users = User.objects.in_bulk(set([m.sender_id for m in messages] + [m.recipient_id for m in messages]))
+        for m in messages:
+            m.sender = users[m.sender_id]
+            m.recipient = users[m.recipient_id]
+
         return messages
 
     def reply(self, sender, recipient, msg):
@@ -75,11 +138,12 @@ class Message(models.Model):
         :param msg: The message contents
         :return: The message that was sent
         """
-        message = Message.objects.create(sender=sender, recipient=recipient, text=msg)
-        message.previous_message = self
+        message = Message.objects.create(sender=sender, recipient=recipient, text=msg, previous_message=self)
+
+        if Message.objects.filter(pk=self.pk, is_read=False).update(is_read=True):
+            UnreadCounter.invalidate(self.recipient_id)
         self.is_read = True
-        self.save()
-        message.save()
+
         return message
 
     def get_type_str(self):
@@ -99,15 +163,150 @@ class Message(models.Model):
             return 'Unknown'
 
     @staticmethod
-    def send(sender, recipient, msg, msg_type=MessageType.Normal):
+    def send(sender, recipient, msg, msg_type=MessageType.Normal, is_notification=False):
         """
         Send a new message
         :param sender: The user sending the message
         :param recipient: The user receiving the message
         :param msg: The message contents
         :param msg_type: The type of the message
+        :param is_notification: Whether or not the message is a system notification
         :return: The message that was sent
         """
-        message = Message.objects.create(sender=sender, recipient=recipient, text=msg, type=msg_type)
-        message.save()
+        message = Message.objects.create(sender=sender, recipient=recipient, text=msg, type=msg_type,
+                                         is_notification=is_notification)
         return message
+
+    @staticmethod
+    def send_bulk(sender, recipients, msg, msg_type=MessageType.Normal, is_notification=False, batch_size=None):
+        """
+        Send the same message to many users with a single bulk insert
+        :param sender: The user sending the messages; None to have each recipient send
+                       their own message, as notifications do
+        :param recipients: The users receiving the message
+        :param msg: The message contents
+        :param msg_type: The type of the message
+        :param is_notification: Whether or not the messages are system notifications
+        :param batch_size: The number of rows per INSERT statement; None to let Django decide
+        :return: A list of the messages that were sent
+        """
+        html = Message.render_html(msg)
+        messages = [Message(sender=recipient if sender is None else sender, recipient=recipient, text=msg, html=html,
+                            type=msg_type, is_notification=is_notification) for recipient in recipients]
+
+        with transaction.atomic():
+            Message.objects.bulk_create(messages, batch_size=batch_size)
+
+        UnreadCounter.invalidate(*[message.recipient_id for message in messages])
+
+        return messages
+
+    @staticmethod
+    def get_broadcast_recipients(sender, target, hospital=None):
+        """
+        Get the users a broadcast is delivered to
+        :param sender: The user sending the broadcast; they do not receive it
+        :param target: The BroadcastTarget to send to
+        :param hospital: The hospital whose staff and patients receive a Hospital broadcast
+        :return: A queryset of users
+        """
+        from django.db.models import Q
+        from healthnet.core.users.user import User
+
+        if target == BroadcastTarget.Hospital:
+            members = User.objects.filter(Q(administrator__hospital=hospital) | Q(doctor__hospitals=hospital) |
+                                          Q(nurse__hospital=hospital) | Q(patient__hospital=hospital))
+        elif target == BroadcastTarget.Doctors:
+            members = User.objects.filter(doctor__isnull=False)
+        elif target == BroadcastTarget.Nurses:
+            members = User.objects.filter(nurse__isnull=False)
+        else:
+            return User.objects.none()
+
+        # Doctors join across hospitals, so collapse duplicates with a subquery
+        return User.objects.filter(pk__in=members.values('pk')).exclude(pk=sender.pk)
+
+    @staticmethod
+    def deliver_broadcast(sender, recipients, msg, msg_type=MessageType.Normal, batch_size=500):
+        """
+        Deliver a message to every recipient, one bulk insert per batch
+        :param sender: The user sending the broadcast
+        :param recipients: A queryset of the users receiving the broadcast
+        :param msg: The message contents
+        :param msg_type: The type of the message
+        :param batch_size: The number of recipients to deliver to per batch
+        :return: The number of messages sent
+        """
+        sent = 0
+        last_pk = 0
+        while True:
+            batch = list(recipients.filter(pk__gt=last_pk).order_by('pk').only('pk')[:batch_size])
+            if not batch:
+                return sent
+
+            Message.send_bulk(sender, batch, msg, msg_type)
+            sent += len(batch)
+            last_pk = batch[-1].pk
+
+    @staticmethod
+    def broadcast(sender, target, msg, msg_type=MessageType.Normal, hospital=None, batch_size=500):
+        """
+        Send a message to a hospital, all doctors or all nurses. Delivery
+        happens in the request, one keyset batch at a time, so each batch
+        is a short write and a failure reaches the sender
+        :param sender: The user sending the broadcast
+        :param target: The BroadcastTarget to send to
+        :param msg: The message contents
+        :param msg_type: The type of the message
+        :param hospital: The hospital to send to when target is BroadcastTarget.Hospital
+        :param batch_size: The number of recipients to deliver to per batch
+        :return: The number of messages sent
+        """
+        recipients = Message.get_broadcast_recipients(sender, target, hospital)
+        return Message.deliver_broadcast(sender, recipients, msg, msg_type, batch_size)
+
+
+class UnreadCounter(object):
+    """
+    A cached count of each users unread messages. Anything that changes
+    a users unread messages deletes their count, and it is recounted
+    from the database the next time it is read, so the count is never
+    adjusted in one process while another holds a different copy.
+    """
+
+    # Bounds how long a recount that raced with a change can be stale
+    TIMEOUT = 5 * 60
+
+    @staticmethod
+    def get_key(user_pk):
+        """
+        Get the cache key for a users count
+        :param user_pk: The pk of the user
+        :return: The cache key
+        """
+        return 'healthnet:unread_messages:%s' % user_pk
+
+    @staticmethod
+    def get(user_pk):
+        """
+        Get the number of unread messages a user has
+        :param user_pk: The pk of the user
+        :return: The number of unread messages
+        """
+        key = UnreadCounter.get_key(user_pk)
+        count = cache.get(key)
+
+        if count is None:
+            count = Message.objects.filter(recipient_id=user_pk, is_read=False).count()
+            cache.set(key, count, UnreadCounter.TIMEOUT)
+
+        return count
+
+    @staticmethod
+    def invalidate(*user_pks):
+        """
+        Forget the counts of users whose unread messages changed
+        :param user_pks: The pks of the users
+        :return: None
+        """
+        cache.delete_many([UnreadCounter.get_key(pk) for pk in set(user_pks)])
@@ -0,0 +1,79 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class KeysetPaginator(object):
+    """
+    Pages through a queryset newest first, ordered by a field and then pk.
+    Each page continues from the last object of the previous page instead of
+    using an offset, so deep pages cost the same as the first one.
+    """
+
+    def __init__(self, queryset, field, per_page=25):
+        """
+        Initialize the paginator
+        :param queryset: The queryset to page through
+        :param field: The name of the field to order by, e.g. a date
+        :param per_page: The number of objects on each page
+        """
+        self.queryset = queryset
+        self.field = field
+        self.per_page = per_page
+
+    def get_model_field(self):
+        """
+        Get the model field being ordered by
+        :return: The field
+        """
+        meta = self.queryset.model._meta
+        return meta.pk if self.field == 'pk' else meta.get_field(self.field)
+
+    def get_cursor(self, obj):
+        """
+        Get the cursor for the page after an object. It holds the
+        objects field and pk, so the next page needs no lookup of the
+        object, and works even if the object has since been deleted.
+        :param obj: The last object on a page
+        :return: The cursor string
+        """
+        value = json.dumps([self.get_model_field().value_to_string(obj), obj.pk])
+        return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+    def parse_cursor(self, value):
+        """
+        Parse a cursor sent by the client
+        :param value: The cursor string
+        :return: A tuple of the field value and pk, or None if it is missing or invalid
+        """
+        if not value:
+            return None
+
+        try:
+            field_value, pk = json.loads(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode())
+            return self.get_model_field().to_python(field_value), int(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, ValidationError):
+            return None
+
+    def page(self, before=None):
+        """
+        Get a page of objects
+        :param before: The cursor of the previous page; None or an invalid cursor for the first page
+        :return: A tuple of the objects on the page and the cursor for the next page, None if it is the last page
+        """
+        objects = self.queryset.order_by('-' + self.field, '-pk')
+
+        cursor = self.parse_cursor(before)
+        if cursor is not None:
+            pivot, pk = cursor
+            objects = objects.filter(Q(**{self.field + '__lt': pivot}) | Q(**{self.field: pivot, 'pk__lt': pk}))
+
+        # Fetch one extra to know if there is another page
+        objects = list(objects[:self.per_page + 1])
+
+        if len(objects) > self.per_page:
+            return objects[:self.per_page], self.get_cursor(objects[self.per_page - 1])
+        return objects, None
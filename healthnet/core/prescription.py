@@ -1,3 +1,5 @@
+import datetime
+
 import django
 from django.db import models
 
@@ -32,3 +34,22 @@ class Prescription(models.Model):
         """
         return '%s%s, %s, %s %s' % \
                (self.address_line_1, self.address_line_2, self.city, States.get_str(self.state), self.zipcode)
+
+    def save(self, *args, **kwargs):
+        """
+        Save the prescription, counting it in its hospital's
+        daily statistics when it is first issued
+        :param args: arguments to Model.save
+        :param kwargs: kwarguments to Model.save
+        :return: None
+        """
+        from healthnet.core.hospital import HospitalDailyPrescriptions
+
+        adding = self._state.adding
+        super(Prescription, self).save(*args, **kwargs)
+
+        if adding and self.patient is not None:
+            issue_date = self.issue_date
+            if isinstance(issue_date, datetime.datetime):
+                issue_date = django.utils.timezone.localtime(issue_date).date()
+            HospitalDailyPrescriptions.add(self.patient.hospital_id, issue_date, self.name)
@@ -16,7 +16,7 @@ class Doctor(User):
         :return: A queryset of appointments
         """
         from healthnet.core.calendar import Appointment
-        return Appointment.objects.filter(attendees=User.objects.get(pk=self.pk))
+        return Appointment.objects.filter(attendees__pk=self.pk)
 
     def get_patients(self):
         """
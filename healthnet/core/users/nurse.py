@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Q
 
 from healthnet.core.calendar import Appointment
 from healthnet.core.users.user import User
@@ -24,20 +25,22 @@ class Nurse(User):
         Get all appointments for this nurse
         :return: A queryset of appointments
         """
-        apts = Appointment.objects.filter(pk=None)
-        for p in self.get_patients():
-            for apt in p.get_appointments():
-                apts |= Appointment.objects.filter(pk=apt.pk)
-        return apts
+        if self.hospital is None:
+            return Appointment.objects.none()
+
+        # Filter through a subquery so the queryset has no duplicates and can still be combined
+        return Appointment.objects.filter(
+            pk__in=Appointment.objects.filter(attendees__patient__hospital=self.hospital).values('pk'))
 
     def get_attendee_queryset(self):
         """
         Get all the possible attendees for this nurse
         :return: A queryset of Users
         """
-        a = User.objects.filter(pk=None)
-        for d in self.hospital.get_doctors():
-            a |= User.objects.filter(pk=d.pk)
-            for p in d.get_patients():
-                a |= User.objects.filter(pk=p.pk)
-        return a
+        if self.hospital is None:
+            return User.objects.none()
+
+        # Doctors of the hospital and the patients they are the primary care provider for
+        return User.objects.filter(
+            pk__in=User.objects.filter(Q(doctor__hospitals=self.hospital) |
+                                       Q(patient__primary_care_provider__hospitals=self.hospital)).values('pk'))
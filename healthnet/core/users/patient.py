@@ -2,7 +2,8 @@ from datetime import date, timedelta
 
 import django
 from django.core.validators import MaxValueValidator, MinValueValidator, RegexValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, ExpressionWrapper, F, When
 
 from healthnet.core.enumfield import EnumField
 from healthnet.core.prescription import Prescription
@@ -63,6 +64,12 @@ class Patient(User):
     average_visit_length = models.IntegerField(default=0)  # seconds
     visits = models.IntegerField(default=0)
 
+    # Running totals of completed visits; see toggle_admit. Visits from before
+    # stay lengths were recorded are counted once backfill_statistics has run
+    visit_length_count = models.IntegerField(default=0)
+    visit_length_sum = models.BigIntegerField(default=0)  # seconds
+    visit_length_sumsq = models.BigIntegerField(default=0)  # seconds squared
+
     @staticmethod
     def create_patient(health_id, email, username, password, first_name, last_name, dob, hospital, pcp):
         """
@@ -100,7 +107,7 @@ class Patient(User):
         :return: A queryset of appointments
         """
         from healthnet.core.calendar import Appointment
-        return Appointment.objects.filter(attendees=User.objects.get(pk=self.pk))
+        return Appointment.objects.filter(attendees__pk=self.pk)
 
     def get_hospitals(self):
         """
@@ -147,31 +154,57 @@ class Patient(User):
         today = date.today()
         return today.year - self.dob.year - ((today.month, today.day) < (self.dob.month, self.dob.day))
 
-    def toggle_admit(self, force=False):
+    def toggle_admit(self, force=False, discharge_from=None):
         """
         Toggle whether or not the patient is admitted
-        to their hospital
+        to their hospital; a forced admit of an admitted
+        patient ends their current stay and starts a new one
         :param force: Whether or not to force admit
+        :param discharge_from: The pk of the hospital a current stay is at, if it
+                               is no longer the patients hospital
         :return: None
         """
-        self.is_admitted = not self.is_admitted or force
-
-        if self.is_admitted:
-            # Set last admitted date
-            self.last_admit_date = django.utils.timezone.now()
+        from healthnet.core.admission import Admission
 
-            # Increment visits
-            self.visits += 1
-        else:
-            # Calculate average visit
-            if self.last_admit_date is not None:
-                self.average_visit_length += (django.utils.timezone.now() - self.last_admit_date).total_seconds()
-                self.average_visit_length /= 2
-
-            # Clear admit date
-            self.last_admit_date = None
+        now = django.utils.timezone.now()
+        was_admitted = self.is_admitted
+        self.is_admitted = not self.is_admitted or force
 
-        self.save()
+        with transaction.atomic():
+            if was_admitted:
+                length = Admission.discharge(self, now, discharge_from)
+
+                if length is not None:
+                    # Until the running totals count every earlier visit, the average
+                    # is the only record of those visits, so it is left alone
+                    Patient.objects.filter(pk=self.pk).update(
+                            visit_length_count=F('visit_length_count') + 1,
+                            visit_length_sum=F('visit_length_sum') + length,
+                            visit_length_sumsq=F('visit_length_sumsq') + length * length,
+                            average_visit_length=Case(
+                                    When(visit_length_count__gte=F('visits') - 1, then=ExpressionWrapper(
+                                            (F('visit_length_sum') + length) / (F('visit_length_count') + 1),
+                                            output_field=models.IntegerField())),
+                                    default=F('average_visit_length'), output_field=models.IntegerField()))
+
+                    if self.visit_length_count >= self.visits - 1:
+                        self.average_visit_length = (self.visit_length_sum + length) // (self.visit_length_count + 1)
+                    self.visit_length_count += 1
+                    self.visit_length_sum += length
+                    self.visit_length_sumsq += length * length
+
+            if self.is_admitted:
+                Admission.admit(self, now)
+
+                # Set last admitted date and increment visits
+                Patient.objects.filter(pk=self.pk).update(is_admitted=True, last_admit_date=now,
+                                                          visits=F('visits') + 1)
+                self.last_admit_date = now
+                self.visits += 1
+            else:
+                # Clear admit date
+                Patient.objects.filter(pk=self.pk).update(is_admitted=False, last_admit_date=None)
+                self.last_admit_date = None
 
     def transfer(self, hospital):
         """
@@ -179,6 +212,8 @@ class Patient(User):
         :param hospital: The hospital to transfer to
         :return: None
         """
+        # A stay from before stays were recorded is credited to the hospital being left
+        previous_hospital_id = self.hospital_id
         self.hospital = hospital
-        self.toggle_admit(True)
-        self.save()
+        self.save(update_fields=['hospital'])
+        self.toggle_admit(True, discharge_from=previous_hospital_id)
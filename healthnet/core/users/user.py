@@ -46,6 +46,11 @@ class User(AbstractBaseUser):
     first_name = models.CharField(max_length=50)
     last_name = models.CharField(max_length=50)
 
+    # Lower case copies of the names, set on save; see search
+    search_username = models.CharField(max_length=25, db_index=True, default='', editable=False)
+    search_first_name = models.CharField(max_length=50, db_index=True, default='', editable=False)
+    search_last_name = models.CharField(max_length=50, db_index=True, default='', editable=False)
+
     is_admin = models.BooleanField(default=False)
     is_doctor = models.BooleanField(default=False)
     is_patient = models.BooleanField(default=False)
@@ -62,6 +67,9 @@ class User(AbstractBaseUser):
 
     USERNAME_FIELD = 'username'
 
+    # The concrete Administrator, Doctor, Nurse or Patient row; see get_typed_user
+    _typed_user = None
+
     @staticmethod
     def create_user(username, password, usertype: UserType, email, first_name="", last_name="", print_stdout=True,
                     primary_care_provider_id=None, hospital_id=None, health_insurance_number=None):
@@ -165,21 +173,41 @@ class User(AbstractBaseUser):
             del request.session['current_user_is_patient']
         if 'current_user_display_name' in request.session:
             del request.session['current_user_display_name']
+        if hasattr(request, 'healthnet_user'):
+            request.healthnet_user = None
 
     @staticmethod
     def get_logged_in(request):
         """
         Check to see if logged in
         :param request: request being addressed
-        :return: true if logged in, false otherwise
+        :return: the logged in user, None otherwise
         """
+        # Already resolved for this request by CurrentUserMiddleware
+        if hasattr(request, 'healthnet_user'):
+            return request.healthnet_user
+
         try:
             if request.session['current_user_pk'] is None:
                 return None
         except KeyError:
             return None
 
-        return User.objects.get(pk=request.session['current_user_pk'])
+        try:
+            return User.get_with_typed_user(request.session['current_user_pk'])
+        except User.DoesNotExist:
+            return None
+
+    @staticmethod
+    def get_with_typed_user(pk):
+        """
+        Gets a user along with their concrete user type in a single query
+        :param pk: The pk of the user
+        :return: The user, with get_typed_user already resolved
+        """
+        user = User.objects.select_related('administrator', 'doctor', 'nurse', 'patient').get(pk=pk)
+        user.get_typed_user()
+        return user
 
     def get_display_name(self):
         """
@@ -219,6 +247,56 @@ class User(AbstractBaseUser):
         if self.is_patient:
             return UserType.Patient
 
+    # The names copied to the search_* fields
+    SEARCH_FIELDS = (('username', 'search_username'), ('first_name', 'search_first_name'),
+                     ('last_name', 'search_last_name'))
+
+    def save(self, *args, **kwargs):
+        """
+        Save the user, copying its names to the search fields whenever they are saved
+        :param args: arguments to Model.save
+        :param kwargs: kwarguments to Model.save
+        :return: None
+        """
+        update_fields = kwargs.get('update_fields')
+        for field, search_field in User.SEARCH_FIELDS:
+            if update_fields is None or field in update_fields:
+                setattr(self, search_field, (getattr(self, field) or '').lower())
+                if update_fields is not None:
+                    update_fields = list(update_fields) + [search_field]
+        if update_fields is not None:
+            kwargs['update_fields'] = update_fields
+        super(User, self).save(*args, **kwargs)
+
+    @staticmethod
+    def search(prefix, exclude=None, limit=10):
+        """
+        Find users whose username, first or last name starts with a prefix,
+        ignoring case. istartswith is a LIKE, which SQLite can't answer from
+        an ordinary index, so this asks for a range of the lower case copies
+        of the names instead; each range is a search of its own index.
+        :param prefix: The text the user has typed so far
+        :param exclude: A user to leave out of the results, usually the one searching
+        :param limit: The most users to return
+        :return: A list of users ordered by last then first name
+        """
+        from django.db.models import Q
+
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+
+        # Every string starting with the prefix sorts between these
+        low, high = prefix, prefix + '\U0010ffff'
+        users = User.objects.filter(Q(search_username__gte=low, search_username__lt=high) |
+                                    Q(search_first_name__gte=low, search_first_name__lt=high) |
+                                    Q(search_last_name__gte=low, search_last_name__lt=high))
+        if exclude is not None:
+            users = users.exclude(pk=exclude.pk)
+
+        return list(users.order_by('last_name', 'first_name', 'pk')
+                    .only('pk', 'username', 'first_name', 'last_name')[:limit])
+
     def get_user_type_name(self):
         """
         Get the string representation of this users type
@@ -231,7 +309,8 @@ class User(AbstractBaseUser):
         Get the number of new messages this user has
         :return: An integer representing the number of new messages
         """
-        return self.received_messages.filter(is_read=False).count()
+        from healthnet.core.messages import UnreadCounter
+        return UnreadCounter.get(self.pk)
 
     def get_view_context(self):
         """
@@ -242,14 +321,28 @@ class User(AbstractBaseUser):
             'num_msgs': self.get_num_new_msgs()
         }
 
-    def mark_messages_read(self):
+    def mark_messages_read(self, messages=None, thread=None):
         """
-        Mark all the users messages read
-        :return: None
+        Mark the users messages read with a single update
+        :param messages: A list of pks of the messages to mark; None for every message
+        :param thread: A message whose thread should be marked; None for every message
+        :return: The number of messages that were marked read
         """
-        for i in self.received_messages.filter(is_read=False):
-            i.is_read = True
-            i.save()
+        unread = self.received_messages.filter(is_read=False)
+
+        if messages is not None:
+            unread = unread.filter(pk__in=messages)
+
+        if thread is not None:
+            unread = unread.filter(pk__in=[m.pk for m in thread.get_previous_messages()])
+
+        count = unread.update(is_read=True)
+
+        if count:
+            from healthnet.core.messages import UnreadCounter
+            UnreadCounter.invalidate(self.pk)
+
+        return count
 
     def render_for_user(self, request, template, context):
         """
@@ -263,8 +356,8 @@ class User(AbstractBaseUser):
         user_context.update(self.get_view_context())
 
         if self.is_type(UserType.Administrator):
-            if Administrator.objects.get(pk=self.pk).hospital is not None:
-                user_context['admin_hospital'] = Administrator.objects.get(pk=self.pk).hospital.pk
+            if self.get_typed_user().hospital_id is not None:
+                user_context['admin_hospital'] = self.get_typed_user().hospital_id
 
         return render(request, template, user_context)
 
@@ -273,23 +366,18 @@ class User(AbstractBaseUser):
         Gets a user casted to their specific UserType
         :return: The type casted user
         """
-        if self.is_type(UserType.Patient):
-            from healthnet.core.users.patient import Patient
-            return Patient.objects.get(username=self.username)
+        if type(self) is not User:
+            return self
 
-        if self.is_type(UserType.Doctor):
-            from healthnet.core.users.doctor import Doctor
-            return Doctor.objects.get(username=self.username)
+        if self._typed_user is None:
+            usertype = self.get_user_type()
+            if usertype is None:
+                return self
 
-        if self.is_type(UserType.Nurse):
-            from healthnet.core.users.nurse import Nurse
-            return Nurse.objects.get(username=self.username)
+            # Uses the row fetched by select_related when there is one, otherwise queries for it
+            self._typed_user = getattr(self, UserType.get_type_name(usertype).lower())
 
-        if self.is_type(UserType.Administrator):
-            from healthnet.core.users.administrator import Administrator
-            return Administrator.objects.get(username=self.username)
-
-        return self
+        return self._typed_user
 
     def get_appointments(self):
         """
@@ -341,9 +429,18 @@ class User(AbstractBaseUser):
         :return: None
         """
         from healthnet.core.messages import Message, MessageType
-        msg = Message.send(self, self, msg, MessageType.Normal)
-        msg.is_notification = True
-        msg.save()
+        Message.send(self, self, msg, MessageType.Normal, is_notification=True)
+
+    @staticmethod
+    def notify_many(users, msg):
+        """
+        Send the same notification to many users at once
+        :param users: The users to notify
+        :param msg: The message for the notification
+        :return: None
+        """
+        from healthnet.core.messages import Message, MessageType
+        Message.send_bulk(None, users, msg, MessageType.Normal, is_notification=True)
 
     def approve(self):
         """
@@ -361,10 +458,9 @@ class User(AbstractBaseUser):
         :param typed_user_set: A query set of non generic users
         :return: A query set of generic users
         """
-        out = User.objects.filter(pk=None)
-        for u in typed_user_set:
-            out |= User.objects.filter(pk=u.pk)
-        return out
+        if isinstance(typed_user_set, models.QuerySet):
+            return User.objects.filter(pk__in=typed_user_set.values('pk'))
+        return User.objects.filter(pk__in=[u.pk for u in typed_user_set])
 
     def __unicode__(self):
         """
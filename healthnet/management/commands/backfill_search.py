@@ -0,0 +1,46 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from healthnet.core.users.user import User
+
+
+class Command(BaseCommand):
+    """
+    Fills the lower case search copies of the usernames and names of users
+    saved before they were stored, so User.search can find them
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        """
+        Handle the command
+        :param options: options for the command
+        :return: None
+        """
+        chunk_size = options['chunk_size']
+        fields = [field for field, search_field in User.SEARCH_FIELDS]
+        search_fields = [search_field for field, search_field in User.SEARCH_FIELDS]
+        last_pk = 0
+        total = 0
+
+        while True:
+            chunk = list(User.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', *(fields + search_fields))[:chunk_size])
+            if not chunk:
+                break
+
+            # SQLite's lower() only folds ASCII, so the copies are made the way User.save makes them
+            with transaction.atomic():
+                for row in chunk:
+                    names = row[1:1 + len(fields)]
+                    current = row[1 + len(fields):]
+                    lowered = [(name or '').lower() for name in names]
+                    if lowered != list(current):
+                        User.objects.filter(pk=row[0]).update(**dict(zip(search_fields, lowered)))
+                        total += 1
+
+            last_pk = chunk[-1][0]
+
+        print('Filled the search fields of %d users.' % total)
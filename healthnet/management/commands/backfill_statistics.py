@@ -0,0 +1,119 @@
+import collections
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from healthnet.core.admission import Admission, VisitLengthBucket
+from healthnet.core.hospital import Hospital, HospitalDailyStats, HospitalDailyPrescriptions
+from healthnet.core.prescription import Prescription
+from healthnet.core.users.patient import Patient
+
+
+class Command(BaseCommand):
+    """
+    Rebuilds the daily hospital statistics, the visit length ranges and
+    the running visit length totals from the rows they summarize. Stays
+    from before admissions were recorded are only known for patients who
+    are still admitted, and by each patients average visit length.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        """
+        Handle the command
+        :param options: options for the command
+        :return: None
+        """
+        batch_size = options['batch_size']
+
+        # (hospital, day) -> [admissions, discharges, total visit length]
+        days = collections.defaultdict(lambda: [0, 0, 0])
+        # (hospital, length range) -> visits
+        buckets = collections.Counter()
+        for hospital_id, admitted, discharged, length in Admission.objects \
+                .values_list('hospital_id', 'admitted', 'discharged', 'length').iterator():
+            days[(hospital_id, timezone.localtime(admitted).date())][0] += 1
+            if discharged is not None:
+                day = days[(hospital_id, timezone.localtime(discharged).date())]
+                day[1] += 1
+                day[2] += length or 0
+            if length is not None:
+                buckets[(hospital_id, VisitLengthBucket.get_bucket(length))] += 1
+
+        # Admitted before stays were recorded
+        for hospital_id, admit_date in Patient.objects \
+                .filter(is_admitted=True, last_admit_date__isnull=False, admissions__isnull=True) \
+                .values_list('hospital_id', 'last_admit_date').iterator():
+            days[(hospital_id, timezone.localtime(admit_date).date())][0] += 1
+
+        prescriptions = Prescription.objects.filter(patient__isnull=False) \
+            .values_list('patient__hospital', 'issue_date', 'name').annotate(count=Count('pk')).order_by()
+
+        totals = Admission.objects.filter(length__isnull=False)
+        length_sq = Sum(F('length') * F('length'))
+
+        with transaction.atomic():
+            HospitalDailyStats.objects.all().delete()
+            HospitalDailyPrescriptions.objects.all().delete()
+            VisitLengthBucket.objects.all().delete()
+
+            HospitalDailyStats.objects.bulk_create(
+                    [HospitalDailyStats(hospital_id=hospital_id, date=date, admissions=admissions,
+                                        discharges=discharges, total_visit_length=length)
+                     for (hospital_id, date), (admissions, discharges, length) in days.items()],
+                    batch_size=batch_size)
+            HospitalDailyPrescriptions.objects.bulk_create(
+                    [HospitalDailyPrescriptions(hospital_id=hospital_id, date=date, name=name, count=count)
+                     for hospital_id, date, name, count in prescriptions.iterator()], batch_size=batch_size)
+            VisitLengthBucket.objects.bulk_create(
+                    [VisitLengthBucket(hospital_id=hospital_id, bucket=bucket, count=count)
+                     for (hospital_id, bucket), count in buckets.items()], batch_size=batch_size)
+
+            Hospital.objects.update(visit_count=0, visit_length_sum=0, visit_length_sumsq=0)
+            for hospital_id, count, total, total_sq in totals.values_list('hospital_id') \
+                    .annotate(Count('length'), Sum('length'), length_sq).order_by():
+                Hospital.objects.filter(pk=hospital_id).update(visit_count=count, visit_length_sum=total,
+                                                               visit_length_sumsq=total_sq)
+
+        # Visits from before stays were recorded are only known by the patients average,
+        # so they are counted as that many visits of the average length
+        patients = 0
+        last_pk = 0
+        while True:
+            chunk = list(Patient.objects.filter(pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', 'visits', 'is_admitted', 'average_visit_length', 'visit_length_count',
+                                      'visit_length_sum')[:batch_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1][0]
+
+            recorded = {patient_id: (count, total, total_sq) for patient_id, count, total, total_sq in totals
+                        .filter(patient_id__in=[row[0] for row in chunk]).values_list('patient_id')
+                        .annotate(Count('length'), Sum('length'), length_sq).order_by()}
+
+            with transaction.atomic():
+                for pk, visits, is_admitted, average, seeded_count, seeded_sum in chunk:
+                    count, total, total_sq = recorded.get(pk, (0, 0, 0))
+                    legacy_count = max(visits - int(is_admitted) - count, 0)
+                    if seeded_count > count:
+                        # Seeded by an earlier run, which may have changed the average
+                        legacy_sum = seeded_sum - total
+                    else:
+                        legacy_sum = average * legacy_count
+
+                    if count + legacy_count == 0:
+                        continue
+
+                    Patient.objects.filter(pk=pk).update(
+                            visit_length_count=count + legacy_count, visit_length_sum=total + legacy_sum,
+                            visit_length_sumsq=total_sq + (legacy_sum * legacy_sum // legacy_count
+                                                           if legacy_count else 0),
+                            average_visit_length=(total + legacy_sum) // (count + legacy_count))
+                    patients += 1
+
+        print('Rebuilt statistics for %d hospital days, %d prescription days and %d patients.' % (
+            len(days), HospitalDailyPrescriptions.objects.count(), patients))
@@ -1,4 +1,6 @@
+import collections
 import datetime
+import sys
 
 from django.core.management import BaseCommand
 
@@ -15,59 +17,132 @@ from healthnet.core.users.patient import Patient
 
 
 class Command(BaseCommand):
-    def handle(self, **options):
-        exp = HealthNetExport()
-
-        for h in Hospital.objects.all():
-            exp.add_hospital(pk=h.pk, name=h.name, addr=h.get_address_str())
-
-        for i in Administrator.objects.all():
-            exp.add_admin(pk=i.pk, username=i.username, password_hash=i.password, first_name=i.first_name,
-                          last_name=i.last_name, middle_name="", dob=datetime.datetime.now(), addr="", email=i.email,
-                          phone="",
-                          primary_hospital_id=i.hospital.pk, hospital_ids=[i.hospital.pk])
-
-        for i in Doctor.objects.all():
-            exp.add_doctor(pk=i.pk, username=i.username, password_hash=i.password, first_name=i.first_name,
-                           last_name=i.last_name, middle_name="", dob=datetime.datetime.now(), addr="", email=i.email,
-                           phone="",
-                           hospital_ids=[h.pk for h in i.get_hospitals()], patient_ids=[p.pk for p in i.get_patients()])
-
-        for i in Nurse.objects.all():
-            exp.add_nurse(pk=i.pk, username=i.username, password_hash=i.password, first_name=i.first_name,
-                          last_name=i.last_name, middle_name="", dob=datetime.datetime.now(), addr="", email=i.email,
-                          phone="",
-                          primary_hospital_id=i.hospital.pk if i.hospital is not None else None,
-                          doctor_ids=[])
-
-        for i in Patient.objects.all():
-            exp.add_patient(pk=i.pk, username=i.username, password_hash=i.password, first_name=i.first_name,
-                            middle_name="", last_name=i.last_name, dob=i.dob, addr=i.get_address_str(), email=i.email,
-                            phone=i.home_phone,
-                            emergency_contact=i.emergency_contact + ' ' + i.emergency_contact_number, eye_color="",
-                            bloodtype="", height=i.height,
-                            weight=i.weight, primary_hospital_id=i.hospital.pk if i.hospital is not None else None,
-                            primary_doctor_id=i.primary_care_provider.pk if i.primary_care_provider is not None else None,
-                            doctor_ids=[i.primary_care_provider.pk] if i.primary_care_provider is not None else [])
-
-        for i in Appointment.objects.all():
-            exp.add_appointment(start=i.tstart, end=i.tend, location="", description=i.description,
-                                doctor_ids=[u.pk for u in i.attendees.filter(is_doctor=True)],
-                                patient_ids=[u.pk for u in i.attendees.filter(is_patient=True)],
-                                nurse_ids=[u.pk for u in i.attendees.filter(is_nurse=True)])
-
-        for i in Prescription.objects.all():
+    """
+    Exports HealthNet data as JSON, writing each object as it is read
+    so memory use doesn't grow with the size of the database
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('-o', '--output', help='The file to write to, instead of stdout')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    @staticmethod
+    def chunks(queryset, chunk_size):
+        """
+        Read a queryset in pk order, a chunk at a time
+        :param queryset: The queryset
+        :param chunk_size: The number of objects per chunk
+        :return: A generator of lists of objects
+        """
+        last = None
+        while True:
+            chunk = queryset.order_by('pk')
+            if last is not None:
+                chunk = chunk.filter(pk__gt=last)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last = chunk[-1].pk
+
+    def handle(self, *args, **options):
+        """
+        Handle the command
+        :param options: options for the command
+        :return: None
+        """
+        if options['output']:
+            with open(options['output'], 'w') as out:
+                self.export(out, options['chunk_size'])
+        else:
+            self.export(sys.stdout, options['chunk_size'])
+
+    def export(self, out, chunk_size):
+        """
+        Write the export
+        :param out: The file to write to
+        :param chunk_size: The number of objects read per query
+        :return: None
+        """
+        exp = HealthNetExport(out)
+
+        # Objects reference others that are written later, so every index is known up front
+        for pk_type, model in (('hospitals', Hospital), ('admins', Administrator), ('doctors', Doctor),
+                               ('nurses', Nurse), ('patients', Patient)):
+            exp.set_pks(pk_type, model.objects.order_by('pk').values_list('pk', flat=True).iterator())
+
+        for chunk in self.chunks(Hospital.objects.all(), chunk_size):
+            for h in chunk:
+                exp.add_hospital(pk=h.pk, name=h.name, addr=h.get_address_str())
+
+        for chunk in self.chunks(Administrator.objects.all(), chunk_size):
+            for i in chunk:
+                exp.add_admin(pk=i.pk, username=i.username, password_hash=i.password, first_name=i.first_name,
+                              last_name=i.last_name, middle_name="", dob=datetime.datetime.now(), addr="",
+                              email=i.email, phone="", primary_hospital_id=i.hospital_id,
+                              hospital_ids=[i.hospital_id] if i.hospital_id is not None else [])
+
+        for chunk in self.chunks(Doctor.objects.all(), chunk_size):
+            pks = [i.pk for i in chunk]
+            hospitals = collections.defaultdict(list)
+            for doctor_id, hospital_id in Doctor.hospitals.through.objects.filter(doctor_id__in=pks) \
+                    .values_list('doctor_id', 'hospital_id'):
+                hospitals[doctor_id].append(hospital_id)
+            patients = collections.defaultdict(list)
+            for doctor_id, patient_id in Patient.objects.filter(primary_care_provider_id__in=pks) \
+                    .values_list('primary_care_provider_id', 'pk'):
+                patients[doctor_id].append(patient_id)
+
+            for i in chunk:
+                exp.add_doctor(pk=i.pk, username=i.username, password_hash=i.password, first_name=i.first_name,
+                               last_name=i.last_name, middle_name="", dob=datetime.datetime.now(), addr="",
+                               email=i.email, phone="", hospital_ids=hospitals[i.pk], patient_ids=patients[i.pk])
+
+        for chunk in self.chunks(Nurse.objects.all(), chunk_size):
+            for i in chunk:
+                exp.add_nurse(pk=i.pk, username=i.username, password_hash=i.password, first_name=i.first_name,
+                              last_name=i.last_name, middle_name="", dob=datetime.datetime.now(), addr="",
+                              email=i.email, phone="", primary_hospital_id=i.hospital_id, doctor_ids=[])
+
+        for chunk in self.chunks(Patient.objects.all(), chunk_size):
+            for i in chunk:
+                doctor_id = i.primary_care_provider_id
+                exp.add_patient(pk=i.pk, username=i.username, password_hash=i.password, first_name=i.first_name,
+                                middle_name="", last_name=i.last_name, dob=i.dob, addr=i.get_address_str(),
+                                email=i.email, phone=i.home_phone,
+                                emergency_contact=i.emergency_contact + ' ' + i.emergency_contact_number,
+                                eye_color="", bloodtype="", height=i.height, weight=i.weight,
+                                primary_hospital_id=i.hospital_id, primary_doctor_id=doctor_id,
+                                doctor_ids=[doctor_id] if doctor_id is not None else [])
+
+        for chunk in self.chunks(Appointment.objects.all(), chunk_size):
+            # appointment -> [doctors, nurses, patients]
+            attendees = collections.defaultdict(lambda: ([], [], []))
+            for appointment_id, user_id, is_doctor, is_nurse, is_patient in Appointment.attendees.through.objects \
+                    .filter(appointment_id__in=[i.pk for i in chunk]) \
+                    .values_list('appointment_id', 'user_id', 'user__is_doctor', 'user__is_nurse',
+                                 'user__is_patient'):
+                for ids, is_type in zip(attendees[appointment_id], (is_doctor, is_nurse, is_patient)):
+                    if is_type:
+                        ids.append(user_id)
+
+            for i in chunk:
+                doctor_ids, nurse_ids, patient_ids = attendees[i.pk]
+                exp.add_appointment(start=i.tstart, end=i.tend, location="", description=i.description,
+                                    doctor_ids=doctor_ids, patient_ids=patient_ids, nurse_ids=nurse_ids)
+
+        for i in Prescription.objects.iterator():
             exp.add_prescription(name=i.name, dosage=i.refills,
                                  notes="Expires: " + str(i.expiration_date) + "\n" + i.description,
-                                 doctor_id=i.doctor.pk, patient_id=i.patient.pk)
+                                 doctor_id=i.doctor_id, patient_id=i.patient_id)
 
-        for i in Result.objects.all():
+        for i in Result.objects.iterator():
             exp.add_test(name=i.description, description=i.description, date=i.test_date, released=i.is_released,
-                         results=i.comment, doctor_id=i.doctor.pk, patient_id=i.patient.pk)
+                         results=i.comment, doctor_id=i.doctor_id, patient_id=i.patient_id)
 
-        for i in LogEntry.objects.all():
+        for i in LogEntry.objects.iterator():
             exp.add_log_entry(user_id=None, request_method="", request_secure=False, request_addr="",
                               description=str(i.datetime) + " [" + i.get_level_str() + "] " + i.message,
                               hospital_id=None)
 
-        print(exp.export_json(), end="")
+        exp.close()
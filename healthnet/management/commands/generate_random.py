@@ -7,6 +7,7 @@ from django.core.management import BaseCommand
 import names
 from healthnet.core.calendar import Calendar
 from healthnet.core.hospital import Hospital
+from healthnet.core.insurance import InsuranceNumberGenerator
 from healthnet.core.prescription import Prescription
 from healthnet.core.result import Result
 from healthnet.core.users.doctor import Doctor
@@ -15,6 +16,8 @@ from healthnet.core.users.user import User, UserType
 
 
 class Command(BaseCommand):
+    insurance_numbers = None
+
     def add_arguments(self, parser):
         parser.add_argument('-n', nargs=1, type=int)
 
@@ -72,13 +75,9 @@ class Command(BaseCommand):
         return self.random_string(string.digits, 5)
 
     def random_insurance_number(self):
-        num = ''.join(random.sample(string.ascii_uppercase, 1)).join(
-            random.sample(string.ascii_uppercase + string.digits, 11))
-
-        if Patient.objects.filter(health_insurance_number=num).count() > 0:
-            return self.random_insurance_number()
-
-        return num
+        if self.insurance_numbers is None:
+            self.insurance_numbers = InsuranceNumberGenerator()
+        return self.insurance_numbers.next()
 
     def random_date(self):
         year = random.randint(1950, 2015)
@@ -84,6 +84,9 @@ class Command(BaseCommand):
         # migrate healthnet
         management.call_command('makemigrations', 'healthnet', interactive=False, stdout=None)
         management.call_command('migrate', 'healthnet', interactive=False, stdout=None)
+
+        # cache table
+        management.call_command('createcachetable', interactive=False, stdout=None)
         print("\n")
 
         # Create super users
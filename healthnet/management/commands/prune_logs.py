@@ -0,0 +1,81 @@
+import collections
+import gzip
+import json
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from healthnet.core.logging import LogEntry, LogRollup
+
+
+class Command(BaseCommand):
+    """
+    Archives log entries older than a cutoff to gzipped JSONL files,
+    one per day, then deletes them and keeps a count per day and level.
+    Entries are only deleted once they are synced to disk; a run that
+    crashes in between archives them again on the next run.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help='Keep entries newer than this many days')
+        parser.add_argument('--archive-dir', default=settings.HEALTHNET_LOG_ARCHIVE_DIR)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    @staticmethod
+    def append(path, lines):
+        """
+        Append lines to an archive as a complete gzip member and sync it
+        to disk, so a crash afterwards can't leave a member without its
+        trailer; gzip reads the members of a file one after another
+        :param path: The path of the archive
+        :param lines: The lines to append
+        :return: None
+        """
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as archive:
+                archive.write(''.join(lines).encode('utf-8'))
+            raw.flush()
+            os.fsync(raw.fileno())
+
+    def handle(self, *args, **options):
+        """
+        Handle the command
+        :param options: options for the command
+        :return: None
+        """
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        archive_dir = options['archive_dir']
+        chunk_size = options['chunk_size']
+        os.makedirs(archive_dir, exist_ok=True)
+
+        total = 0
+        while True:
+            chunk = list(LogEntry.objects.filter(datetime__lt=cutoff).order_by('datetime', 'pk')[:chunk_size])
+            if not chunk:
+                break
+
+            lines = collections.OrderedDict()
+            counts = collections.Counter()
+            for entry in chunk:
+                date = timezone.localtime(entry.datetime).date()
+                lines.setdefault(date, []).append(json.dumps({
+                    'id': entry.pk, 'datetime': entry.datetime.isoformat(), 'level': entry.get_level_str(),
+                    'message': entry.message}) + '\n')
+                counts[(date, entry.level)] += 1
+
+            # Get the archived lines to disk before the rows are gone
+            for date, date_lines in lines.items():
+                self.append(os.path.join(archive_dir, 'log-%s.jsonl.gz' % date.isoformat()), date_lines)
+
+            with transaction.atomic():
+                LogEntry.objects.filter(pk__in=[entry.pk for entry in chunk]).delete()
+                for (date, level), count in counts.items():
+                    LogRollup.add(date, level, count)
+
+            total += len(chunk)
+
+        print('Archived and pruned %d log entries older than %s.' % (total, cutoff.strftime('%Y-%m-%d %H:%M')))
@@ -0,0 +1,39 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from healthnet.core.messages import Message
+
+
+class Command(BaseCommand):
+    """
+    Renders and stores the HTML of messages saved before
+    message HTML was stored alongside the text
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        """
+        Handle the command
+        :param options: options for the command
+        :return: None
+        """
+        chunk_size = options['chunk_size']
+        last_pk = 0
+        total = 0
+
+        while True:
+            chunk = list(Message.objects.filter(html='', pk__gt=last_pk).order_by('pk')
+                         .values_list('pk', 'text')[:chunk_size])
+            if not chunk:
+                break
+
+            with transaction.atomic():
+                for pk, text in chunk:
+                    Message.objects.filter(pk=pk).update(html=Message.render_html(text))
+
+            last_pk = chunk[-1][0]
+            total += len(chunk)
+
+        print('Rendered %d messages.' % total)
@@ -0,0 +1,16 @@
+from healthnet.core.users.user import User
+
+
+class CurrentUserMiddleware(object):
+    """
+    Resolves the logged in user once per request, along with their
+    concrete user type, and stores it as request.healthnet_user
+    """
+
+    def process_request(self, request):
+        """
+        Resolve the logged in user for this request
+        :param request: The HTTP request
+        :return: None
+        """
+        request.healthnet_user = User.get_logged_in(request)
@@ -11,13 +11,14 @@ States = EnumField("Alabama", "Alaska", "Arizona", "Arkansas", "California", "Co
                    "Vermont", "Virginia", "Washington", "West Virginia", "Wisconsin", "Wyoming")
 
 # Import External Models
-from healthnet.core.hospital import Hospital
+from healthnet.core.hospital import Hospital, HospitalDailyStats, HospitalDailyPrescriptions
 from healthnet.core.users.user import User
 from healthnet.core.users.patient import Patient
 from healthnet.core.users.doctor import Doctor
 from healthnet.core.users.nurse import Nurse
 from healthnet.core.users.administrator import Administrator
-from healthnet.core.logging import LogEntry
+from healthnet.core.logging import LogEntry, LogRollup
 from healthnet.core.calendar import Calendar, Appointment
 from healthnet.core.prescription import Prescription
 from healthnet.core.result import Result
+from healthnet.core.admission import Admission, VisitLengthBucket
@@ -54,6 +54,7 @@ MIDDLEWARE_CLASSES = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
+    'healthnet.middleware.CurrentUserMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -94,6 +95,35 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+# Every process must see the same cache, since one process deletes entries
+# another has cached. The file based cache lists its directory on every set,
+# so the cache is a table in the database instead; it is culled once it holds
+# more than MAX_ENTRIES, which must stay above the number of users so their
+# unread counts don't evict each other. Create it with createcachetable.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'healthnet_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    }
+}
+
+# Write log entries in batches from a background thread instead of one
+# INSERT per logged event; buffered entries are written at exit, but are lost
+# if the process is killed
+HEALTHNET_LOG_BUFFERED = False
+HEALTHNET_LOG_FLUSH_INTERVAL = 500  # ms an entry may wait before it is written
+HEALTHNET_LOG_BATCH_SIZE = 100
+HEALTHNET_LOG_QUEUE_SIZE = 10000  # loggers block once this many entries are waiting
+
+# Where prune_logs writes archived log entries, one gzipped JSONL file per day
+HEALTHNET_LOG_ARCHIVE_DIR = os.path.join(BASE_DIR, 'log_archive')
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
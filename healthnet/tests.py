@@ -1,8 +1,29 @@
+import gzip
+import io
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
 from unittest import TestCase
 
 from django.contrib.auth import authenticate
+from django.core.management import call_command
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 
+from healthnet.core.admission import Admission, VisitLengthBucket
+from healthnet.core.bulk_import import BulkImportBackend
+from healthnet.core.calendar import Calendar
+from healthnet.core.forms import BroadcastMessageForm
+from healthnet.core.healthnet_porter import HealthNetExport, HealthNetImport, JSONSectionReader
+from healthnet.core.hospital import Hospital, HospitalDailyPrescriptions, HospitalDailyStats
+from healthnet.core.insurance import InsuranceNumberGenerator
+from healthnet.core.logging import LogEntry, LogLevel, LogRollup, LogWriter, Logging
+from healthnet.core.messages import BroadcastTarget, Message
+from healthnet.core.pagination import KeysetPaginator
+from healthnet.core.prescription import Prescription
+from healthnet.core.users.doctor import Doctor
+from healthnet.core.users.patient import Patient
 from healthnet.core.users.user import User, UserType
 
 
@@ -42,3 +63,738 @@ class TestUser(TestCase):
 
         # Check authentication with password
         res = authenticate(username=username, password=password)
+
+    def test_search(self):
+        """
+        Tests that search matches name prefixes whatever
+        their case, including names changed later
+        :return: None
+        """
+        tag = get_random_string(8, 'abcdefghijklmnopqrstuvwxyz')
+        user = User.create_user(tag.upper() + 'x', 'password', UserType.Doctor, '', 'Ada', 'Lovelace' + tag,
+                                print_stdout=False)[1]
+
+        self.assertEqual([u.pk for u in User.search(tag)], [user.pk])
+        self.assertEqual([u.pk for u in User.search('lovelace' + tag.upper())], [user.pk])
+        self.assertEqual(User.search(tag, exclude=user), [])
+
+        user.last_name = 'Byron' + tag
+        user.save(update_fields=['last_name'])
+        self.assertEqual([u.pk for u in User.search('BYRON' + tag)], [user.pk])
+        self.assertEqual(User.search('lovelace' + tag), [])
+
+    def test_backfill_search(self):
+        """
+        Tests that backfill_search fills the search fields
+        of users saved before they were stored
+        :return: None
+        """
+        tag = get_random_string(8, 'abcdefghijklmnopqrstuvwxyz')
+        user = User.create_user(tag.upper() + 'y', 'password', UserType.Nurse, '', 'Grace', 'Hopper' + tag,
+                                print_stdout=False)[1]
+        User.objects.filter(pk=user.pk).update(search_username='', search_first_name='', search_last_name='')
+        self.assertEqual(User.search(tag), [])
+
+        call_command('backfill_search', chunk_size=2)
+        self.assertEqual([u.pk for u in User.search(tag)], [user.pk])
+        self.assertEqual([u.pk for u in User.search('hopper' + tag)], [user.pk])
+
+    def test_generify_queryset(self):
+        """
+        Tests that typed querysets and lists become the same
+        generic users, without evaluating the queryset
+        :return: None
+        """
+        tag = get_random_string(10)
+        doctors = [User.create_user(tag + str(i), 'password', UserType.Doctor, '', print_stdout=False)[1]
+                   for i in range(3)]
+
+        users = User.generify_queryset(Doctor.objects.filter(username__startswith=tag))
+        self.assertIs(users.model, User)
+        self.assertEqual(sorted(u.pk for u in users), sorted(d.pk for d in doctors))
+        self.assertEqual(sorted(u.pk for u in User.generify_queryset(doctors[:2])), sorted(d.pk for d in doctors[:2]))
+
+
+class TestCalendar(TestCase):
+    """
+    Tests the Calendar class
+    """
+
+    def test_get_free_slots(self):
+        """
+        Tests that free slots skip over merged busy
+        intervals and line up with the granularity
+        :return: None
+        """
+        day = datetime(2016, 4, 4)
+        busy = [
+            (day.replace(hour=9, minute=10), day.replace(hour=9, minute=40)),
+            (day.replace(hour=9, minute=30), day.replace(hour=10, minute=5)),
+            (day.replace(hour=11), day.replace(hour=11, minute=30)),
+        ]
+
+        slots = Calendar.get_free_slots(busy, (day.replace(hour=9), day.replace(hour=12)), timedelta(minutes=30),
+                                        timedelta(minutes=15))
+
+        self.assertEqual([s[0] for s in slots], [day.replace(hour=10, minute=15), day.replace(hour=10, minute=30),
+                                                 day.replace(hour=11, minute=30)])
+
+        # Check the limit is respected
+        slots = Calendar.get_free_slots([], (day.replace(hour=9), day.replace(hour=12)), timedelta(minutes=30),
+                                        timedelta(minutes=30), limit=2)
+        self.assertEqual(len(slots), 2)
+
+    def test_get_free_slots_window(self):
+        """
+        Tests that slots listed from now start on a slot boundary
+        :return: None
+        """
+        now = timezone.now()
+        start, end = Calendar.get_free_slots_window(None, None)
+
+        self.assertTrue(now <= start < now + timedelta(minutes=30))
+        self.assertEqual((start.minute % 30, start.second, start.microsecond), (0, 0, 0))
+        self.assertEqual(end - start, timedelta(days=7))
+
+        slots = json.loads(Calendar.get_free_slots_json(User.objects.none(), (start, end), limit=2))
+        self.assertEqual([s['start'] for s in slots],
+                         [timezone.localtime(start + timedelta(minutes=30 * i)).strftime('%Y-%m-%dT%H:%M:%S')
+                          for i in range(2)])
+
+    def test_get_appointments_json_range(self):
+        """
+        Tests that only appointments overlapping the visible range
+        are listed, and that overlapping appointments conflict
+        :return: None
+        """
+        doctor = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+        start = timezone.now().replace(microsecond=0) + timedelta(days=30)
+
+        _, first = Calendar.create_appointment([doctor], doctor, 'First', '', start, start + timedelta(hours=1))
+        _, second = Calendar.create_appointment([doctor], doctor, 'Second', '', start + timedelta(days=3),
+                                                start + timedelta(days=3, hours=1))
+
+        listed = json.loads(Calendar.get_appointments_json(doctor, start - timedelta(days=1),
+                                                           start + timedelta(days=1)))
+        self.assertEqual([a['id'] for a in listed], [first.pk])
+
+        self.assertTrue(Calendar.has_conflict([doctor], start + timedelta(minutes=30), start + timedelta(hours=2)))
+        self.assertFalse(Calendar.has_conflict([doctor], start + timedelta(hours=1), start + timedelta(hours=2)))
+
+
+class TestHealthNetImport(TestCase):
+    """
+    Tests the HealthNetImport class
+    """
+
+    def test_sections_out_of_order(self):
+        """
+        Tests that sections are imported in dependency order
+        when the file lists them in a different order, even
+        when the file is read a few characters at a time
+        :return: None
+        """
+        data = json.dumps({
+            'log_entries': [{'user_id': None, 'request_method': '', 'request_secure': False, 'request_addr': '',
+                             'description': 'Entry %s' % i, 'hospital_id': 0} for i in range(3)],
+            'hospitals': [{'name': 'Strong', 'addr': '601 Elmwood Ave'}],
+        })
+        created = []
+
+        importer = HealthNetImport(io.StringIO(data), create_hospital_func=lambda **h: created.append(h['name']) or 42,
+                                   create_log_func=lambda **l: created.append((l['description'], l['hospital_id'])))
+        importer.import_all()
+
+        self.assertEqual(created, ['Strong', ('Entry 0', 42), ('Entry 1', 42), ('Entry 2', 42)])
+
+        reader = JSONSectionReader(io.StringIO('{"a": [1, 2.5, {"b": "]}"}], "c": 300}'), chunk_size=2)
+        self.assertEqual([(name, list(records)) for name, records in reader.sections()],
+                         [('a', [1, 2.5, {'b': ']}'}]), ('c', [300])])
+
+    def test_report(self):
+        """
+        Tests that the report counts what each section read
+        and created, and progress is reported per chunk
+        :return: None
+        """
+        data = json.dumps({
+            'hospitals': [{'name': 'Hospital %d' % i, 'addr': ''} for i in range(20)],
+            'log_entries': [{'user_id': None, 'request_method': '', 'request_secure': False, 'request_addr': '',
+                             'description': 'Entry %d' % i, 'hospital_id': i % 20} for i in range(50)],
+        })
+        progress = []
+
+        importer = HealthNetImport(io.StringIO(data), create_hospital_func=lambda **h: 1,
+                                   create_log_func=lambda **l: None)
+        report = importer.import_all(chunk_size=7, progress=lambda *args: progress.append(args))
+
+        self.assertEqual([(name, read, created) for name, read, created, _ in report],
+                         [('hospitals', 20, 20), ('log_entries', 50, 50)])
+        self.assertEqual(progress[:3], [('hospitals', 7, 7), ('hospitals', 14, 14), ('hospitals', 20, 20)])
+        self.assertEqual(len(progress), 3 + 8)
+
+
+class TestBulkImportBackend(TestCase):
+    """
+    Tests the BulkImportBackend class
+    """
+
+    @staticmethod
+    def user(**fields):
+        """
+        Build an exported user record
+        :param fields: Fields to add or override
+        :return: The record
+        """
+        user = {'username': get_random_string(10), 'password_hash': '', 'first_name': 'First', 'middle_name': '',
+                'last_name': 'Last', 'dob': '1990-01-01', 'addr': '', 'email': '', 'phone': ''}
+        user.update(fields)
+        return user
+
+    def test_failed_rows(self):
+        """
+        Tests that a bad patient only loses itself, not the rest of its
+        batch, and that rows referencing it are skipped
+        :return: None
+        """
+        patient = dict(emergency_contact='', eye_color='', bloodtype='', height=70, weight=150, primary_hospital_id=0,
+                       primary_doctor_id=0, doctor_ids=[0])
+        patients = [self.user(**patient),
+                    self.user(**dict(patient, first_name=None)),  # fails to insert
+                    self.user(**dict(patient, primary_hospital_id=None))]  # refused before it is queued
+        data = json.dumps({
+            'hospitals': [{'name': 'Strong', 'addr': '601 Elmwood Ave'}],
+            'doctors': [self.user(hospital_ids=[0], patient_ids=[])],
+            'patients': patients,
+            'prescriptions': [{'name': 'Aspirin', 'dosage': 1, 'notes': '', 'doctor_id': 0, 'patient_id': i}
+                              for i in range(3)],
+        })
+
+        backend = BulkImportBackend()
+        HealthNetImport(io.StringIO(data), create_hospital_func=backend.add_hospital,
+                        create_doctor_func=backend.add_doctor, create_patient_func=backend.add_patient,
+                        create_prescription_func=backend.add_prescription).import_all()
+        backend.finish()
+
+        self.assertEqual(backend.created['patients'], 1)
+        self.assertEqual(backend.failed['patients'], 1)
+        self.assertEqual(backend.created['prescriptions'], 1)
+
+        created = Patient.objects.filter(username__in=[p['username'] for p in patients])
+        self.assertEqual([p.username for p in created], [patients[0]['username']])
+        self.assertEqual(Prescription.objects.filter(patient_id__in=backend.failed_pks[User]).count(), 0)
+
+    def test_prescriptions(self):
+        """
+        Tests that imported prescriptions keep their exported expiration
+        date and are counted in their hospital's daily statistics
+        :return: None
+        """
+        name = get_random_string(10)
+        patient = self.user(emergency_contact='', eye_color='', bloodtype='', height=70, weight=150,
+                            primary_hospital_id=0, primary_doctor_id=0, doctor_ids=[0])
+        data = json.dumps({
+            'hospitals': [{'name': 'Strong', 'addr': '601 Elmwood Ave'}],
+            'doctors': [self.user(hospital_ids=[0], patient_ids=[])],
+            'patients': [patient],
+            'prescriptions': [{'name': name, 'dosage': 1, 'notes': 'Expires: 2030-01-02\nTake daily',
+                               'doctor_id': 0, 'patient_id': 0}] * 2,
+        })
+
+        backend = BulkImportBackend()
+        HealthNetImport(io.StringIO(data), create_hospital_func=backend.add_hospital,
+                        create_doctor_func=backend.add_doctor, create_patient_func=backend.add_patient,
+                        create_prescription_func=backend.add_prescription).import_all()
+        backend.finish()
+
+        prescriptions = Prescription.objects.filter(name=name)
+        self.assertEqual([(p.expiration_date.isoformat(), p.description) for p in prescriptions],
+                         [('2030-01-02', 'Take daily')] * 2)
+        hospital_id = Patient.objects.get(username=patient['username']).hospital_id
+        stats = HospitalDailyPrescriptions.objects.get(hospital_id=hospital_id, name=name)
+        self.assertEqual((stats.date, stats.count), (prescriptions[0].issue_date, 2))
+
+
+class TestHealthNetExport(TestCase):
+    """
+    Tests the HealthNetExport class
+    """
+
+    def test_forward_references(self):
+        """
+        Tests that objects written before the objects they
+        reference still get the referenced objects indexes
+        :return: None
+        """
+        out = io.StringIO()
+        exporter = HealthNetExport(out)
+        exporter.set_pks('hospitals', [8, 3])
+        exporter.set_pks('patients', [20])
+
+        exporter.add_prescription(name='Aspirin', dosage=1, notes='', doctor_id=None, patient_id=20)
+        exporter.add_hospital(pk=3, name='Strong', addr='601 Elmwood Ave')
+        exporter.add_hospital(pk=8, name='Highland', addr='1000 South Ave')
+        exporter.add_log_entry(user_id=None, request_method='', request_secure=False, request_addr='',
+                               description='Entry', hospital_id=8)
+        exporter.close()
+
+        data = json.loads(out.getvalue())
+        self.assertEqual([h['name'] for h in data['hospitals']], ['Strong', 'Highland'])
+        self.assertEqual(data['prescriptions'][0]['patient_id'], 0)
+        self.assertEqual(data['log_entries'][0]['hospital_id'], 1)
+        self.assertEqual(data['patients'], [])
+
+        with self.assertRaises(ValueError):
+            exporter = HealthNetExport()
+            exporter.add_hospital(pk=3, name='Strong', addr='601 Elmwood Ave')
+            exporter.add_log_entry(user_id=None, request_method='', request_secure=False, request_addr='',
+                                   description='Entry', hospital_id=3)
+            exporter.add_hospital(pk=8, name='Highland', addr='1000 South Ave')
+
+
+class TestUnreadCounter(TestCase):
+    """
+    Tests the UnreadCounter class
+    """
+
+    def test_count_follows_changes(self):
+        """
+        Tests that the cached unread count is recounted after
+        every kind of change, including a plain save as the
+        admin site does
+        :return: None
+        """
+        sender = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+        recipient = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+        self.assertEqual(recipient.get_num_new_msgs(), 0)
+
+        message = Message.send(sender, recipient, 'Hello')
+        self.assertEqual(recipient.get_num_new_msgs(), 1)
+
+        Message.send_bulk(sender, [recipient, recipient], 'Hello')
+        self.assertEqual(recipient.get_num_new_msgs(), 3)
+
+        message.toggle_unread()
+        self.assertEqual(recipient.get_num_new_msgs(), 2)
+
+        message.is_read = False
+        message.save()
+        self.assertEqual(recipient.get_num_new_msgs(), 3)
+
+        recipient.mark_messages_read()
+        self.assertEqual(recipient.get_num_new_msgs(), 0)
+
+    def test_mark_messages_read(self):
+        """
+        Tests that marking some messages or a thread read
+        leaves the rest of the users messages unread
+        :return: None
+        """
+        sender = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+        recipient = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+        first, second, third = [Message.send(sender, recipient, 'Hello') for _ in range(3)]
+        reply = first.reply(recipient, sender, 'Hi')
+        answer = reply.reply(sender, recipient, 'Hello again')
+
+        self.assertEqual(recipient.mark_messages_read(messages=[second.pk]), 1)
+        self.assertEqual(recipient.get_num_new_msgs(), 2)
+
+        # first was already marked read by the reply
+        self.assertEqual(recipient.mark_messages_read(thread=answer), 1)
+        self.assertEqual(list(recipient.received_messages.filter(is_read=False)), [third])
+
+
+class TestLogging(TestCase):
+    """
+    Tests the Logging class
+    """
+
+    def test_get_entries(self):
+        """
+        Tests that the log page filters combine
+        :return: None
+        """
+        tag = get_random_string(10)
+        now = timezone.now()
+        LogEntry.objects.bulk_create([
+            LogEntry(message='%s login' % tag, level=LogLevel.Info, datetime=now),
+            LogEntry(message='%s failed login' % tag, level=LogLevel.Error, datetime=now),
+            LogEntry(message='%s failed login' % tag, level=LogLevel.Error, datetime=now - timedelta(days=2)),
+        ])
+
+        entries = Logging.get_entries(start=now - timedelta(days=1), level=LogLevel.Error, text=tag.upper())
+        self.assertEqual([e.message for e in entries], ['%s failed login' % tag])
+        self.assertEqual(Logging.get_entries(text=tag).count(), 3)
+
+
+class TestLogWriter(TestCase):
+    """
+    Tests the LogWriter class
+    """
+
+    def test_flush(self):
+        """
+        Tests that flushing writes every buffered entry,
+        including the batch the thread is in the middle
+        of, and that the writer starts again afterwards
+        :return: None
+        """
+        tag = get_random_string(10)
+        writer = LogWriter(flush_interval=0.05, batch_size=3)
+
+        for i in range(10):
+            writer.write(LogEntry(message='%s %d' % (tag, i), level=LogLevel.Info, datetime=timezone.now()))
+        writer.flush()
+
+        self.assertIsNone(writer.thread)
+        self.assertEqual(LogEntry.objects.filter(message__startswith=tag).count(), 10)
+
+        writer.write(LogEntry(message='%s again' % tag, level=LogLevel.Info, datetime=timezone.now()))
+        writer.flush()
+        self.assertEqual(LogEntry.objects.filter(message__startswith=tag).count(), 11)
+
+
+class TestPruneLogs(TestCase):
+    """
+    Tests the prune_logs command
+    """
+
+    def test_archive(self):
+        """
+        Tests that pruned entries can be read back from the
+        archive across chunks and are counted in the rollups
+        :return: None
+        """
+        tag = get_random_string(10)
+        old = timezone.now() - timedelta(days=400)
+        date = timezone.localtime(old).date()
+        rolled_up = sum(LogRollup.objects.filter(date=date, level=LogLevel.Error).values_list('count', flat=True))
+
+        LogEntry.objects.bulk_create([LogEntry(message='%s %d' % (tag, i), level=LogLevel.Error, datetime=old)
+                                      for i in range(5)])
+
+        with tempfile.TemporaryDirectory() as archive_dir:
+            call_command('prune_logs', days=365, archive_dir=archive_dir, chunk_size=2)
+
+            with gzip.open(os.path.join(archive_dir, 'log-%s.jsonl.gz' % date.isoformat()), 'rt') as archive:
+                messages = [json.loads(line)['message'] for line in archive]
+
+        self.assertEqual([m for m in messages if m.startswith(tag)], ['%s %d' % (tag, i) for i in range(5)])
+        self.assertEqual(LogEntry.objects.filter(message__startswith=tag).count(), 0)
+        self.assertEqual(sum(LogRollup.objects.filter(date=date, level=LogLevel.Error)
+                             .values_list('count', flat=True)), rolled_up + 5)
+
+
+class TestAdmission(TestCase):
+    """
+    Tests the Admission class
+    """
+
+    @staticmethod
+    def hospital():
+        """
+        Create a hospital
+        :return: The hospital
+        """
+        return Hospital.objects.create(name=get_random_string(10), address_line_1='', city='', state=0, zipcode='')
+
+    def test_daily_stats(self):
+        """
+        Tests that daily counts add up and fill in the days
+        nothing happened
+        :return: None
+        """
+        hospital = self.hospital()
+        day = timezone.localtime(timezone.now()).date()
+
+        HospitalDailyStats.add(hospital.pk, day, admissions=1)
+        HospitalDailyStats.add(hospital.pk, day, admissions=1, discharges=1, total_visit_length=3600)
+        HospitalDailyStats.add(hospital.pk, day - timedelta(days=2), discharges=1, total_visit_length=7200)
+
+        stats = HospitalDailyStats.get_range(hospital, day - timedelta(days=2), day)
+        self.assertEqual(stats['range_admissions'], 2)
+        self.assertEqual(stats['range_discharges'], 2)
+        self.assertEqual(stats['range_average_visit_length'], timedelta(hours=1, minutes=30))
+        self.assertEqual(json.loads(stats['trend_admissions_json']), [0, 0, 2])
+        self.assertEqual(json.loads(stats['trend_discharges_json']), [1, 0, 1])
+
+    def test_length_percentile(self):
+        """
+        Tests that percentiles read from the length ranges
+        are within a percent of the exact ones
+        :return: None
+        """
+        hospital = self.hospital()
+        self.assertIsNone(Admission.get_length_percentile(hospital, 0.5))
+
+        lengths = [60 * i for i in range(1, 1001)]
+        for length in lengths:
+            VisitLengthBucket.add(hospital.pk, length)
+
+        for fraction in (0.0, 0.5, 0.9, 1.0):
+            exact = lengths[int(round(fraction * (len(lengths) - 1)))]
+            self.assertAlmostEqual(Admission.get_length_percentile(hospital, fraction), exact, delta=exact * 0.01)
+
+    def test_legacy_average_visit_length(self):
+        """
+        Tests that a discharge keeps the average of visits from before
+        stay lengths were recorded until backfill_statistics counts them
+        :return: None
+        """
+        doctor = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+        patient = User.create_user(get_random_string(10), 'password', UserType.Patient, '', print_stdout=False,
+                                   primary_care_provider_id=doctor.pk, hospital_id=self.hospital().pk,
+                                   health_insurance_number=InsuranceNumberGenerator().next())[1]
+        Patient.objects.filter(pk=patient.pk).update(visits=2, average_visit_length=7200)
+        patient = Patient.objects.get(pk=patient.pk)
+
+        patient.toggle_admit()
+        Admission.objects.filter(patient=patient).update(admitted=timezone.now() - timedelta(hours=1))
+        patient.toggle_admit()
+        self.assertEqual(Patient.objects.get(pk=patient.pk).average_visit_length, 7200)
+
+        for _ in range(2):
+            call_command('backfill_statistics')
+            patient = Patient.objects.get(pk=patient.pk)
+            self.assertEqual(patient.visit_length_count, 3)
+            self.assertAlmostEqual(patient.average_visit_length, (2 * 7200 + 3600) // 3, delta=60)
+
+        patient.toggle_admit()
+        patient.toggle_admit()
+        self.assertLess(Patient.objects.get(pk=patient.pk).average_visit_length, (2 * 7200 + 3600) // 3)
+
+    def test_transfer_before_stays_were_recorded(self):
+        """
+        Tests that a stay from before admissions were recorded
+        is credited to the hospital a transfer leaves
+        :return: None
+        """
+        old_hospital, new_hospital = self.hospital(), self.hospital()
+        doctor = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+        patient = User.create_user(get_random_string(10), 'password', UserType.Patient, '', print_stdout=False,
+                                   primary_care_provider_id=doctor.pk, hospital_id=old_hospital.pk,
+                                   health_insurance_number=InsuranceNumberGenerator().next())[1]
+        Patient.objects.filter(pk=patient.pk).update(is_admitted=True,
+                                                     last_admit_date=timezone.now() - timedelta(hours=5))
+        patient = Patient.objects.get(pk=patient.pk)
+
+        patient.transfer(new_hospital)
+
+        stays = list(Admission.objects.filter(patient=patient).order_by('admitted'))
+        self.assertEqual([s.hospital_id for s in stays], [old_hospital.pk, new_hospital.pk])
+        self.assertAlmostEqual(stays[0].length, 5 * 60 * 60, delta=60)
+        self.assertEqual(Hospital.objects.get(pk=old_hospital.pk).visit_count, 1)
+        self.assertEqual(Hospital.objects.get(pk=new_hospital.pk).visit_count, 0)
+
+
+class TestMessage(TestCase):
+    """
+    Tests the Message class
+    """
+
+    def test_html(self):
+        """
+        Tests that the rendered HTML is stored with the
+        message and kept up to date when the text changes
+        :return: None
+        """
+        user = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+        message = Message.send(user, user, 'Take **two**')
+        self.assertIn('<strong>two</strong>', Message.objects.get(pk=message.pk).html)
+
+        message.text = 'Take *one*'
+        message.save(update_fields=['text'])
+        self.assertIn('<em>one</em>', Message.objects.get(pk=message.pk).html)
+
+    def test_get_previous_messages(self):
+        """
+        Tests that a thread is loaded oldest first with its users
+        :return: None
+        """
+        doctor = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+        nurse = User.create_user(get_random_string(10), 'password', UserType.Nurse, '', print_stdout=False)[1]
+
+        first = Message.send(doctor, nurse, 'First')
+        second = first.reply(nurse, doctor, 'Second')
+        third = second.reply(doctor, nurse, 'Third')
+
+        thread = third.get_previous_messages()
+        self.assertEqual([m.pk for m in thread], [first.pk, second.pk, third.pk])
+        self.assertEqual([m.sender.pk for m in thread], [doctor.pk, nurse.pk, doctor.pk])
+
+
+class TestNotifications(TestCase):
+    """
+    Tests sending notifications to many users
+    """
+
+    def test_notify_many(self):
+        """
+        Tests that each user gets their own notification,
+        sent by themselves as notifications are
+        :return: None
+        """
+        tag = get_random_string(10)
+        users = [User.create_user(get_random_string(10), 'password', UserType.Nurse, '', print_stdout=False)[1]
+                 for _ in range(3)]
+
+        User.notify_many(users, tag)
+
+        notifications = Message.objects.filter(text=tag, is_notification=True)
+        self.assertEqual(sorted((m.sender_id, m.recipient_id) for m in notifications),
+                         sorted((u.pk, u.pk) for u in users))
+        for user in users:
+            self.assertEqual(user.get_num_new_msgs(), 1)
+
+
+class TestBroadcast(TestCase):
+    """
+    Tests broadcasting messages
+    """
+
+    @staticmethod
+    def user(usertype, hospital):
+        """
+        Create a user in a hospital
+        :param usertype: The type of user
+        :param hospital: Their hospital
+        :return: The user
+        """
+        if usertype == UserType.Patient:
+            doctor = User.create_user(get_random_string(10), 'password', UserType.Doctor, '', print_stdout=False)[1]
+            return User.create_user(get_random_string(10), 'password', usertype, '', print_stdout=False,
+                                    primary_care_provider_id=doctor.pk, hospital_id=hospital.pk,
+                                    health_insurance_number=InsuranceNumberGenerator().next())[1]
+
+        user = User.create_user(get_random_string(10), 'password', usertype, '', print_stdout=False)[1]
+        if usertype == UserType.Doctor:
+            user.hospitals.add(hospital)
+        else:
+            user.hospital = hospital
+            user.save()
+        return user
+
+    def test_get_broadcast_recipients(self):
+        """
+        Tests that a hospital broadcast reaches its staff and patients
+        once each, and the others reach every doctor or nurse
+        :return: None
+        """
+        hospital, other_hospital = TestAdmission.hospital(), TestAdmission.hospital()
+        sender = self.user(UserType.Administrator, hospital)
+        admin = self.user(UserType.Administrator, hospital)
+        doctor = self.user(UserType.Doctor, hospital)
+        doctor.hospitals.add(other_hospital)
+        nurse = self.user(UserType.Nurse, hospital)
+        patient = self.user(UserType.Patient, hospital)
+        other_nurse = self.user(UserType.Nurse, other_hospital)
+
+        recipients = list(Message.get_broadcast_recipients(sender, BroadcastTarget.Hospital, hospital)
+                          .values_list('pk', flat=True))
+        self.assertEqual(sorted(recipients), sorted([admin.pk, doctor.pk, nurse.pk, patient.pk]))
+
+        users = [sender.pk, doctor.pk, nurse.pk, patient.pk, other_nurse.pk]
+        doctors = Message.get_broadcast_recipients(sender, BroadcastTarget.Doctors).filter(pk__in=users)
+        self.assertEqual(list(doctors.values_list('pk', flat=True)), [doctor.pk])
+        nurses = Message.get_broadcast_recipients(sender, BroadcastTarget.Nurses).filter(pk__in=users)
+        self.assertEqual(sorted(nurses.values_list('pk', flat=True)), sorted([nurse.pk, other_nurse.pk]))
+
+    def test_form_hospital(self):
+        """
+        Tests that an administrator can only broadcast to their own hospital
+        :return: None
+        """
+        hospital, other_hospital = TestAdmission.hospital(), TestAdmission.hospital()
+        sender = self.user(UserType.Administrator, hospital)
+        data = {'target': BroadcastTarget.Hospital, 'type': 0, 'message': 'Hello'}
+
+        self.assertTrue(BroadcastMessageForm(dict(data, hospital=hospital.pk), sender=sender).is_valid())
+        form = BroadcastMessageForm(dict(data, hospital=other_hospital.pk), sender=sender)
+        self.assertFalse(form.is_valid())
+        self.assertIn('hospital', form.errors)
+
+    def test_broadcast(self):
+        """
+        Tests that a broadcast delivered over several batches
+        reaches each recipient once
+        :return: None
+        """
+        tag = get_random_string(10)
+        hospital = TestAdmission.hospital()
+        sender = self.user(UserType.Administrator, hospital)
+        nurses = [self.user(UserType.Nurse, hospital) for _ in range(5)]
+
+        self.assertEqual(Message.broadcast(sender, BroadcastTarget.Hospital, tag, hospital=hospital, batch_size=2), 5)
+
+        received = Message.objects.filter(text=tag, sender=sender)
+        self.assertEqual(sorted(received.values_list('recipient_id', flat=True)), sorted(n.pk for n in nurses))
+        for nurse in nurses:
+            self.assertEqual(nurse.get_num_new_msgs(), 1)
+
+
+class TestKeysetPaginator(TestCase):
+    """
+    Tests the KeysetPaginator class
+    """
+
+    def test_pages(self):
+        """
+        Tests that paging visits every object once, newest
+        first, even when the ordering field has ties
+        :return: None
+        """
+        tag = get_random_string(10)
+        now = timezone.now()
+        LogEntry.objects.bulk_create([LogEntry(message=tag, level=LogLevel.Info, datetime=now - timedelta(hours=i // 2))
+                                      for i in range(7)])
+        entries = LogEntry.objects.filter(message=tag)
+        paginator = KeysetPaginator(entries, 'datetime', per_page=3)
+
+        seen = []
+        page, cursor = paginator.page()
+        seen += page
+        while cursor is not None:
+            page, cursor = paginator.page(cursor)
+            seen += page
+
+        self.assertEqual([e.pk for e in seen], [e.pk for e in entries.order_by('-datetime', '-pk')])
+
+    def test_deleted_cursor(self):
+        """
+        Tests that paging continues past an object that was deleted
+        after its page was served, and that a bad cursor is the first page
+        :return: None
+        """
+        tag = get_random_string(10)
+        now = timezone.now()
+        LogEntry.objects.bulk_create([LogEntry(message=tag, level=LogLevel.Info, datetime=now - timedelta(hours=i))
+                                      for i in range(4)])
+        entries = LogEntry.objects.filter(message=tag)
+        paginator = KeysetPaginator(entries, 'datetime', per_page=2)
+
+        first, cursor = paginator.page()
+        first[-1].delete()
+        second, _ = paginator.page(cursor)
+
+        self.assertEqual([e.pk for e in second], [e.pk for e in entries.order_by('-datetime', '-pk')[1:]])
+        self.assertEqual([e.pk for e in paginator.page('not a cursor')[0]], [e.pk for e in paginator.page()[0]])
+
+
+class TestInsuranceNumberGenerator(TestCase):
+    """
+    Tests the InsuranceNumberGenerator class
+    """
+
+    def test_batch(self):
+        """
+        Tests that generated numbers are unique, skip taken
+        numbers and match the insurance number format
+        :return: None
+        """
+        generator = InsuranceNumberGenerator(existing={'A00000000000'})
+        numbers = generator.batch(1000)
+
+        self.assertEqual(len(set(numbers)), 1000)
+        self.assertNotIn('A00000000000', numbers)
+        for num in numbers:
+            self.assertRegex(num, '^[A-Z][A-Z0-9]{11}$')
@@ -23,6 +23,7 @@ from healthnet import views
 urlpatterns = [
                   url(r'^admin/', admin.site.urls),
                   url(r'^dashboard/', views.dashboard, name="dashboard"),
+                  url(r'^appointments_feed/$', views.appointments_feed, name="appointments_feed"),
                   url(r'^log/(?P<start>\d{2}-\d{2}-\d{4})/(?P<end>\d{2}-\d{2}-\d{4})', views.log, name="log"),
                   url(r'^log/', views.log, name="log"),
                   url(r'^result/(?P<pk>\d+)/', views.result, name="result"),
@@ -36,6 +37,7 @@ urlpatterns = [
                   url(r'^create_appointment_1/', views.create_appointment_1, name="create_appointment_1"),
                   url(r'^create_appointment_2/', views.create_appointment_2, name="create_appointment_2"),
                   url(r'^create_appointment_3/', views.create_appointment_3, name="create_appointment_3"),
+                  url(r'^free_slots/$', views.free_slots, name="free_slots"),
                   url(r'^edit_info/(?P<pk>\d+)/$', views.edit_info, name="edit_info"),
                   url(r'^edit_info/', views.edit_info, name="edit_info"),
                   url(r'^edit_appointment/(?P<pk>\d+)/', views.edit_appointment, name="edit_appointment"),
@@ -49,9 +51,13 @@ urlpatterns = [
                   url(r'^toggle_admit/(?P<pk>\d+)/$', views.toggle_admit, name="toggle_admit"),
                   url(r'^transfer/(?P<pk>\d+)/$', views.transfer, name="transfer"),
                   url(r'^toggle_read/(?P<pk>\d+)/$', views.toggle_read, name="toggle_read"),
+                  url(r'^mark_all_read/$', views.mark_all_read, name="mark_all_read"),
+                  url(r'^mark_thread_read/(?P<pk>\d+)/$', views.mark_thread_read, name="mark_thread_read"),
                   url(r'^approve_user/(?P<pk>\d+)/$', views.approve_user, name="approve_user"),
                   url(r'^send_message/(?P<pk>\d+)/$', views.send_message, name="send_message"),
                   url(r'^send_message/', views.send_message, name="send_message"),
+                  url(r'^recipient_search/$', views.recipient_search, name="recipient_search"),
+                  url(r'^broadcast_message/$', views.broadcast_message, name="broadcast_message"),
                   url(r'^reply_message/(?P<pk>\d+)/$', views.reply_message, name="reply_message"),
                   url(r'^sent_messages/', views.sent_messages, name="sent_messages"),
                   url(r'^inbox/', views.inbox, name="inbox"),
@@ -1,20 +1,25 @@
+import csv
+import itertools
 import json
 from datetime import datetime, timedelta
 
 from django.contrib import messages
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, HttpResponse
+from django.db import DatabaseError
+from django.http import HttpResponseRedirect, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.template.loader import render_to_string
+from django.utils import timezone
 
 from healthnet.core.forms import LoginForm, RegistrationForm, AppointmentForm, EditPatientInfoForm, SendMessageForm, \
     ReplyMessageForm, TransferForm, ResultForm, PrescriptionForm, DoctorRegistrationForm, NurseRegistrationForm, \
     AdminRegistrationForm, RegistrationSelectForm, RegisterSelectType, EditNurseInfoForm, EditDoctorInfoForm, \
-    AppointmentOne, AppointmentTwo, AppointmentThree, RequiredRegistrationForm
-from healthnet.core.hospital import Hospital
-from healthnet.core.logging import LogEntry
+    AppointmentOne, AppointmentTwo, AppointmentThree, RequiredRegistrationForm, BroadcastMessageForm
+from healthnet.core.hospital import Hospital, HospitalStats, HospitalDailyStats
+from healthnet.core.logging import LogLevel
 from healthnet.core.logging import Logging
-from healthnet.core.messages import Message, MessageType
-from healthnet.core.users.administrator import Administrator
+from healthnet.core.messages import Message, MessageType, BroadcastTarget
+from healthnet.core.pagination import KeysetPaginator
 from healthnet.core.users.doctor import Doctor
 from healthnet.core.users.nurse import Nurse
 from healthnet.core.users.patient import Patient
@@ -74,9 +79,8 @@ def dashboard(request):
     if user is None:
         return redirect('index')
 
-    # Get list of appointments in json form
+    # Get list of appointments for today; the calendar loads the rest from appointments_feed
     appointments = Calendar.get_appointments_for_attendee_for_day(user, datetime.now())
-    appointments_json = Calendar.get_appointments_json(user)
 
     pending = []
     if user.is_type(UserType.Administrator):
@@ -92,7 +96,6 @@ def dashboard(request):
 
     context = {
         'appointments': appointments,
-        'appointments_json': appointments_json,
         'username': request.user.username,
         'patients': patients,
         'pending_users': pending
@@ -107,6 +110,30 @@ def dashboard(request):
     return user.render_for_user(request, 'dashboard.html', context)
 
 
+def appointments_feed(request):
+    """
+    Lists the logged in users appointments that fall in the
+    range shown by the dashboard calendar
+    :param request: The http request; may contain start and end parameters
+    :return: A JSON list of appointments
+    """
+    user = User.get_logged_in(request)
+
+    # Require login
+    if user is None:
+        return redirect('index')
+
+    start = Calendar.parse_time(request.GET.get('start'))
+    if start is None:
+        start = timezone.now() - timedelta(days=31)
+
+    end = Calendar.parse_time(request.GET.get('end'))
+    if end is None:
+        end = start + timedelta(days=62)
+
+    return HttpResponse(Calendar.get_appointments_json(user, start, end), content_type='application/json')
+
+
 def create_appointment_1(request):
     """
     The first step in the create appointment form
@@ -171,19 +198,49 @@ def create_appointment_2(request):
     else:
         appointment_form = AppointmentTwo()
 
-    attendees = request.session['create_appointment_attendees']
-    attendees |= User.objects.filter(pk=user.pk)
-
     context = {
         'step': 2,
         'total_steps': 3,
-        'appointments': Calendar.get_appointments_json_multi(attendees, show_info=False),
         'appointment_form': appointment_form
     }
 
     return user.render_for_user(request, 'appointment.html', context)
 
 
+def free_slots(request):
+    """
+    Lists the open slots for the attendees chosen in the
+    first step of the create appointment form
+    :param request: The http request; may contain start, end and limit parameters
+    :return: A JSON list of open slots
+    """
+    user = User.get_logged_in(request)
+
+    # Require login
+    if user is None:
+        return redirect('index')
+
+    if 'create_appointment_attendees' not in request.session:
+        return HttpResponse('[]', content_type='application/json')
+
+    attendees = request.session['create_appointment_attendees']
+    attendees |= User.objects.filter(pk=user.pk)
+
+    start, end = Calendar.get_free_slots_window(Calendar.parse_time(request.GET.get('start')),
+                                                Calendar.parse_time(request.GET.get('end')))
+
+    # Bound the work by the window rather than the number of slots, so every slot the calendar shows is listed
+    window_slots = (end - start) // timedelta(minutes=30)
+
+    try:
+        limit = min(int(request.GET['limit']), window_slots)
+    except (KeyError, ValueError):
+        limit = window_slots
+
+    return HttpResponse(Calendar.get_free_slots_json(attendees, (start, end), limit=limit),
+                        content_type='application/json')
+
+
 def create_appointment_3(request):
     """
     The third step in the create appointment form
@@ -234,10 +291,10 @@ def create_appointment_3(request):
                 messages.success(request, "Your appointment has been created")
                 Logging.info("Created appointment '%s'" % name)
 
-                for a in attendees:
-                    a.notify(
-                        "A new appointment has been created for you.\n\n**Name:** %s\n**Description:** %s\n**Start:** %s\n**End:** %s" % (
-                            apt.name, apt.description, apt.tstart.strftime('%c'), apt.tend.strftime('%c')))
+                User.notify_many(
+                    attendees,
+                    "A new appointment has been created for you.\n\n**Name:** %s\n**Description:** %s\n**Start:** %s\n**End:** %s" % (
+                        apt.name, apt.description, apt.tstart.strftime('%c'), apt.tend.strftime('%c')))
 
                 return redirect('dashboard')
     else:
@@ -455,10 +512,10 @@ def log(request, start=None, end=None):
     User tries to access the log
     :param end: The log end date
     :param start: The log start date
-    :param request: request to access the log
+    :param request: request to access the log; may contain level, q, before and format parameters
     :return: If User is noone, they go to the index page
                 If they are not an admin, they get denined
-                If they are an admin, they got to the log page
+                If they are an admin, they got to the log page or download the log as csv or jsonl
     """
     user = User.get_logged_in(request)
 
@@ -471,25 +528,92 @@ def log(request, start=None, end=None):
         return HttpResponse("Access Denied!")
 
     # Get date range if one is provided
-    entries = LogEntry.objects.all()
-
     if start is not None and end is not None:
         try:
             start = datetime.strptime(start, '%m-%d-%Y')
             end = datetime.strptime(end, '%m-%d-%Y')
-            entries = LogEntry.objects.filter(datetime__gt=start, datetime__lt=end)
         except ValueError:
-            pass
+            start = end = None
+
+    try:
+        level = int(request.GET.get('level', ''))
+    except ValueError:
+        level = None
+    if level not in dict(LogLevel.get_choices()):
+        level = None
+    text = request.GET.get('q', '').strip()
+
+    entries = Logging.get_entries(start, end, level, text)
+
+    download = request.GET.get('format')
+    if download in ('csv', 'jsonl'):
+        return log_download(entries, download)
+
+    paginator = KeysetPaginator(entries, 'datetime', per_page=50)
+    page, next_cursor = paginator.page(request.GET.get('before'))
+
+    # Filters to carry over to the next page and downloads
+    query = request.GET.copy()
+    for param in ('before', 'format'):
+        query.pop(param, None)
 
     context = {
         'start': start.strftime('%B %d, %Y') if start is not None else None,
         'end': end.strftime('%B %d, %Y') if end is not None else None,
-        'log_entries': entries
+        'log_entries': page,
+        'next_cursor': next_cursor,
+        'is_first_page': 'before' not in request.GET,
+        'levels': LogLevel.get_choices(),
+        'level': level,
+        'q': text,
+        'filter_query': query.urlencode(),
+        'archived_counts': Logging.get_archived_counts(start.date() if start is not None else None,
+                                                       end.date() if end is not None else None),
     }
 
     return user.render_for_user(request, 'log.html', context)
 
 
+class Echo(object):
+    """
+    A file-like object that hands back what is written to it, so
+    csv.writer can produce rows for a streaming response
+    """
+
+    def write(self, value):
+        """
+        Return the value instead of storing it
+        :param value: The value written
+        :return: The value
+        """
+        return value
+
+
+def log_download(entries, file_format):
+    """
+    Stream log entries to the client, oldest first, without loading them all into memory
+    :param entries: A queryset of the log entries to download
+    :param file_format: Either 'csv' or 'jsonl'
+    :return: The streaming response
+    """
+    entries = entries.order_by('datetime', 'pk').iterator()
+
+    if file_format == 'csv':
+        writer = csv.writer(Echo())
+        rows = itertools.chain([writer.writerow(['id', 'datetime', 'level', 'message'])],
+                               (writer.writerow([e.pk, e.datetime.isoformat(), e.get_level_str(), e.message])
+                                for e in entries))
+        content_type = 'text/csv'
+    else:
+        rows = (json.dumps({'id': e.pk, 'datetime': e.datetime.isoformat(), 'level': e.get_level_str(),
+                            'message': e.message}) + '\n' for e in entries)
+        content_type = 'application/x-ndjson'
+
+    response = StreamingHttpResponse(rows, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="log.%s"' % file_format
+    return response
+
+
 def export(request, start=None, end=None):
     """
     User tries to access the log
@@ -602,10 +726,10 @@ def edit_appointment(request, pk):
                     Logging.info("Appointment with pk '%s' edited by '%s" % (apt.pk, user.username))
                     messages.success(request, 'Your appointment has been updated')
 
-                    for a in apt.attendees.all():
-                        a.notify(
-                                "An appointment you are attending has been updated.\n\n**Name:** %s\n**Description:** %s\n**Start:** %s\n**End:** %s" % (
-                                    apt.name, apt.description, apt.tstart.strftime('%c'), apt.tend.strftime('%c')))
+                    User.notify_many(
+                        apt.attendees.all(),
+                        "An appointment you are attending has been updated.\n\n**Name:** %s\n**Description:** %s\n**Start:** %s\n**End:** %s" % (
+                            apt.name, apt.description, apt.tstart.strftime('%c'), apt.tend.strftime('%c')))
 
                     return redirect('dashboard')
         else:
@@ -718,6 +842,49 @@ def toggle_read(request, pk):
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
 
+def mark_all_read(request):
+    """
+    Mark all of the logged in users messages read
+    :param request: The HTTP request
+    :return: redirects back to last page
+    """
+    user = User.get_logged_in(request)
+
+    # Require login
+    if user is None:
+        return redirect('index')
+
+    count = user.mark_messages_read()
+    messages.success(request, "%s message%s marked as read." % (count, '' if count == 1 else 's'))
+
+    return HttpResponseRedirect(request.META.get('HTTP_REFERER', reverse('inbox')))
+
+
+def mark_thread_read(request, pk):
+    """
+    Mark every message in a thread read
+    :param request: The HTTP request
+    :param pk: The pk of the last message in the thread
+    :return: redirects back to last page
+    """
+    user = User.get_logged_in(request)
+
+    # Require login
+    if user is None:
+        return redirect('index')
+
+    # Get message based on pk argument
+    msg = Message.objects.get(pk=pk)
+
+    # check user can see this message
+    if msg.recipient_id != user.pk:
+        messages.error(request, "You aren't allowed to read this message!")
+    else:
+        user.mark_messages_read(thread=msg)
+
+    return HttpResponseRedirect(request.META.get('HTTP_REFERER', reverse('inbox')))
+
+
 def approve_user(request, pk):
     """
     Approve a user
@@ -771,14 +938,80 @@ def send_message(request, pk=None):
             return redirect('inbox')
     else:
         form = SendMessageForm(sender=user, initial={'recipient': pk, 'type': MessageType.Normal})
+
+    # Name of the chosen recipient for the autocomplete box
+    recipient_pk = form['recipient'].value()
+    recipient = User.objects.filter(pk=recipient_pk).first() if str(recipient_pk or '').isdigit() else None
+
     context = {
         'is_message_page': True,
         'form': form,
+        'recipient': recipient,
     }
 
     return user.render_for_user(request, 'send_message.html', context)
 
 
+def recipient_search(request):
+    """
+    Autocomplete the recipient of a message
+    :param request: The HTTP request; the typed text is in the term parameter
+    :return: A JSON list of matching users
+    """
+    user = User.get_logged_in(request)
+
+    # Require login
+    if user is None or user.is_type(UserType.Patient):
+        return JsonResponse([], safe=False, status=403)
+
+    return JsonResponse([{'id': u.pk, 'label': str(u), 'value': str(u)}
+                         for u in User.search(request.GET.get('term', ''), exclude=user)], safe=False)
+
+
+def broadcast_message(request):
+    """
+    Send a message to everyone in a hospital, all doctors or all nurses
+    :param request: The HTTP request
+    :return: The view to render
+    """
+    user = User.get_logged_in(request)
+
+    # Require login
+    if user is None:
+        return redirect('index')
+
+    if not user.is_type(UserType.Administrator):
+        messages.error(request, "You're not allowed to broadcast messages.")
+        return redirect('inbox')
+
+    if request.method == 'POST':
+        form = BroadcastMessageForm(request.POST, sender=user)
+
+        if form.is_valid():
+            target = BroadcastTarget.get_str(form.cleaned_data['target'])
+            try:
+                sent = Message.broadcast(user, form.cleaned_data['target'], form.cleaned_data['message'],
+                                         form.cleaned_data['type'], form.cleaned_data['hospital'])
+            except DatabaseError as e:
+                Logging.error("Message broadcast to %s by '%s' failed: %s" % (target, user.username, e))
+                messages.error(request, "Your message couldn't be delivered to everyone. Check your sent "
+                                        "messages before trying again.")
+                return redirect('inbox')
+
+            Logging.info("Message broadcast to %s by '%s' delivered to %d users" % (target, user.username, sent))
+            messages.success(request, "Your message was delivered to %d users!" % sent)
+            return redirect('inbox')
+    else:
+        form = BroadcastMessageForm(initial={'target': BroadcastTarget.Hospital, 'type': MessageType.Normal,
+                                             'hospital': user.get_typed_user().hospital_id}, sender=user)
+    context = {
+        'is_message_page': True,
+        'form': form,
+    }
+
+    return user.render_for_user(request, 'broadcast_message.html', context)
+
+
 def reply_message(request, pk):
     """
     Reply to a message
@@ -832,6 +1065,35 @@ def reply_message(request, pk):
     return user.render_for_user(request, 'reply_message.html', context)
 
 
+def message_page(request, user, msgs, context):
+    """
+    Render one page of messages, either as the full
+    message page or as JSON for loading more messages
+    :param request: The HTTP request; may contain before and format parameters
+    :param user: The logged in user
+    :param msgs: A queryset of the messages to page through
+    :param context: additional context to use
+    :return: The view to render
+    """
+    paginator = KeysetPaginator(msgs.select_related('sender', 'recipient'), 'date')
+    page, next_cursor = paginator.page(request.GET.get('before'))
+
+    context = dict(context)
+    context.update({
+        'is_message_page': True,
+        'msgs': page,
+        'next_cursor': next_cursor
+    })
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'html': render_to_string('fragments/messages.html', context, request=request),
+            'next': next_cursor
+        })
+
+    return user.render_for_user(request, 'inbox.html', context)
+
+
 def inbox(request):
     """
     The message inbox view
@@ -846,12 +1108,7 @@ def inbox(request):
 
     # user.mark_messages_read()
 
-    context = {
-        'is_message_page': True,
-        'msgs': user.received_messages.order_by('-date')
-    }
-
-    return user.render_for_user(request, 'inbox.html', context)
+    return message_page(request, user, user.received_messages.all(), {})
 
 
 def sent_messages(request):
@@ -866,13 +1123,7 @@ def sent_messages(request):
     if user is None:
         return redirect('index')
 
-    context = {
-        'is_message_page': True,
-        'is_sent': True,
-        'msgs': user.sent_messages.order_by('-date')
-    }
-
-    return user.render_for_user(request, 'inbox.html', context)
+    return message_page(request, user, user.sent_messages.all(), {'is_sent': True})
 
 
 def doctor_registration(request):
@@ -1173,7 +1424,7 @@ def result(request, pk):
 def statistics(request, pk, start=None, end=None):
     """
     Shows statistics for a hospital
-    :param request: The HTTP request
+    :param request: The HTTP request; may contain a before parameter to page through the patients
     :param pk: The pk of the hospital
     :return: The view to render
     """
@@ -1185,10 +1436,10 @@ def statistics(request, pk, start=None, end=None):
     if not user.is_type(UserType.Administrator):
         return redirect('index')
 
-    user = Administrator.objects.get(pk=user.pk)
+    user = user.get_typed_user()
     hospital = Hospital.objects.get(pk=pk)
 
-    if user.hospital.pk != hospital.pk:
+    if user.hospital_id != hospital.pk:
         messages.error(request, "You don't have permission to view statistics about this hospital")
         return redirect('index')
 
@@ -1198,12 +1449,14 @@ def statistics(request, pk, start=None, end=None):
             start = datetime.strptime(start, '%m-%d-%Y')
             end = datetime.strptime(end, '%m-%d-%Y')
         except ValueError:
-            pass
+            start = end = None
 
-    # Get stats
-    patients = Patient.objects.all()
-    visits, length = hospital.get_visits_and_length()
-    popular_scripts = hospital.get_popular_prescriptions()
+    # Trends cover the chosen range, or the last year
+    if start is not None and end is not None:
+        range_start, range_end = start.date(), end.date()
+    else:
+        range_end = timezone.localtime(timezone.now()).date()
+        range_start = range_end - timedelta(days=365)
 
     # Bar graph prescription name and number scripts
     # Average Prescription length
@@ -1214,17 +1467,12 @@ def statistics(request, pk, start=None, end=None):
         'start': start.strftime('%B %d, %Y') if start is not None else None,
         'end': end.strftime('%B %d, %Y') if end is not None else None,
         'hospital_pk': pk,
-
-        'number_patients': patients.count(),
-        'average_visits': visits,
-        'average_visit_length': length,
-        'num_patients_discharged': patients.filter(is_admitted=False).count(),
-        'num_patients_admitted': patients.filter(is_admitted=True).count(),
-        'patients': patients,
-        'popular_scripts_names_json': json.dumps([p[0] for p in popular_scripts[:5]]),
-        'popular_scripts_values_json': json.dumps([p[1] for p in popular_scripts[:5]]),
-        'average_script_length': hospital.get_average_prescription_length()
     }
+    context.update(HospitalStats.get(hospital))
+    context.update(HospitalDailyStats.get_range(hospital, range_start, range_end))
+
+    context['patients'], context['next_cursor'] = HospitalStats.get_patients_page(hospital, request.GET.get('before'))
+    context['is_first_page'] = 'before' not in request.GET
 
     return user.render_for_user(request, 'statistics.html', context)
 
@@ -1265,7 +1513,7 @@ def create_test_result(request, pk, id=None):
     if user is None:
         return redirect('index')
 
-    doctor = Doctor.objects.get(pk=user.pk)
+    doctor = user.get_typed_user()
     patient = Patient.objects.get(pk=pk)
 
     if request.method == 'POST':
@@ -1286,7 +1534,7 @@ def create_test_result(request, pk, id=None):
         else:
             print('invalid')
     else:
-        result_form = ResultForm(initial={'doctor': Doctor.objects.get(username=user.username), 'test_type': id})
+        result_form = ResultForm(initial={'doctor': doctor, 'test_type': id})
 
     context = {
         'result_form': result_form
@@ -1339,14 +1587,14 @@ def create_prescription(request, pk, id=None):
     if user is None:
         return redirect('index')
 
-    doctor = Doctor.objects.get(pk=user.pk)
+    doctor = user.get_typed_user()
     patient = Patient.objects.get(pk=pk)
 
     if request.method == 'POST':
         prescription_form = PrescriptionForm(request.POST, initial={'doctor': doctor, 'patient': patient})
 
         if prescription_form.is_valid() and user.is_type(UserType.Doctor):
-            new = prescription_form.save()
+            new = prescription_form.save(commit=False)
             new.doctor = doctor
             new.patient = patient
             new.save()
@@ -1407,7 +1655,7 @@ def view_profile(request, pk):
         return redirect('index')
 
     if user.is_type(UserType.Patient):
-        patient = Patient.objects.get(pk=user.pk)
+        patient = user.get_typed_user()
         context = {
             'patient': patient,
             'pk': pk,
@@ -2,4 +2,7 @@ python manage.py makemigrations
 python manage.py migrate
 
 python manage.py makemigrations healthnet
-python manage.py migrate healthnet
\ No newline at end of file
+python manage.py migrate healthnet
+
+python manage.py createcachetable
+python manage.py backfill_search
\ No newline at end of file
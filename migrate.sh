@@ -5,3 +5,5 @@ python manage.py migrate
 python manage.py makemigrations healthnet
 python manage.py migrate healthnet
 
+python manage.py createcachetable
+python manage.py backfill_search